@@ -18,7 +18,7 @@ def initDB():
         try:
             dbconn = lite.connect(db)
             dbc = dbconn.cursor()
-            dbc.execute("CREATE TABLE devices (dev_name TEXT, first_seen TEXT, last_seen TEXT, freq INT, crit_sys INT, inactive INT, inactive_date TEXT, not_log INT, notlog_date TEXT, dev_id INTEGER PRIMARY KEY AUTOINCREMENT)")
+            createDB(dbc)
             dbconn.commit()
             dbconn.close()
         except lite.Error as e:
@@ -26,3 +26,44 @@ def initDB():
             log("[!] Quitting.\n\n")
             raise SystemExit
 
+
+# Create the table structure of a new database
+# Takes a sqlite3 database cursor as an argument
+def createDB(dbc):
+    dbc.execute("CREATE TABLE devices (dev_name TEXT, first_seen TEXT, last_seen TEXT, freq INT, crit_sys INT, inactive INT, inactive_date TEXT, not_log INT, notlog_date TEXT, dev_id INTEGER PRIMARY KEY AUTOINCREMENT)")
+    upgradeDB(dbc)
+
+# Add the tables and columns introduced after the database was first generated.  Safe to run on every start
+# Takes a sqlite3 database cursor as an argument
+def upgradeDB(dbc):
+    try:
+        # Device names are stored relative to the root directory they were found under
+        dbc.execute("CREATE TABLE IF NOT EXISTS roots (root_id INTEGER PRIMARY KEY, root_path TEXT UNIQUE)")
+        dbc.execute("PRAGMA table_info(devices)")
+        if "root_id" not in [c[1] for c in dbc.fetchall()]:
+            dbc.execute("ALTER TABLE devices ADD COLUMN root_id INT")
+        # Directories searched without finding any devices, with the mtimes of their subdirectories
+        dbc.execute("CREATE TABLE IF NOT EXISTS discovery (path TEXT PRIMARY KEY, mtimes TEXT, listing TEXT, checked TEXT)")
+        # Rolling window of daily log volume per device, stored as day:bytes:files:hours samples
+        dbc.execute("CREATE TABLE IF NOT EXISTS volume (dev_id INTEGER PRIMARY KEY, window TEXT)")
+        # Devices already checked by an audit that has not finished yet
+        dbc.execute("CREATE TABLE IF NOT EXISTS checkpoint (dev_id INTEGER PRIMARY KEY, run_date TEXT)")
+        # Devices left unchecked when an audit ran out of time, checked first by the next audit
+        dbc.execute("CREATE TABLE IF NOT EXISTS deferred (dev_id INTEGER PRIMARY KEY, deferred_date TEXT)")
+        # Every CEF event sent for a device, with the day as a date ordinal
+        dbc.execute("CREATE TABLE IF NOT EXISTS events (dev_name TEXT, code INT, day INT)")
+        dbc.execute("CREATE INDEX IF NOT EXISTS events_dev_day ON events (dev_name, day)")
+        dbc.execute("CREATE INDEX IF NOT EXISTS events_code_day ON events (code, day)")
+        # Number of routine events sent each day, which are not stored one by one
+        dbc.execute("CREATE TABLE IF NOT EXISTS event_counts (code INT, day INT, count INT, PRIMARY KEY (code, day))")
+        # Days covered by rotated and compressed log archives, as comma separated date ordinals, kept until the archive's
+        # size or mtime changes
+        dbc.execute("CREATE TABLE IF NOT EXISTS archive_index (path TEXT PRIMARY KEY, size INT, mtime REAL, days TEXT)")
+        # The days a full audit finished, used to find the days missed since
+        dbc.execute("CREATE TABLE IF NOT EXISTS audit_runs (run_date TEXT PRIMARY KEY, finished TEXT)")
+        # Number of the last journaled transaction of an in-memory database that is included in this file
+        dbc.execute("CREATE TABLE IF NOT EXISTS journal_state (id INTEGER PRIMARY KEY, seq INT)")
+    except lite.Error as e:
+        log("[!] Error: " + str(e) + "\n")
+        log("[!] Quitting.\n\n")
+        raise SystemExit
@@ -32,7 +32,10 @@
 # ASSUMPTIONS: 
 ## 1) This program assumes that the device name  immediately follows the path in logDirPath and that the date of the 
 ##    log file is a directory name immediately under the device name: /path/to/logs/DEVICE/DATE/LOG_FILE or /path/to/
-##    logs/DEVICE/DATE/HOUR/LOG_FILE. Modify line 529
+##    logs/DEVICE/DATE/HOUR/LOG_FILE. Set logDirPath in the variables at the top of the file, and change
+##    ptrnDateSubDir and ptrnDateRecalcFreq if your date directories are named differently.  New devices are discovered
+##    using the directory layouts in layoutTemplates, so add a template there if your devices are stored at a different
+##    depth
 ## 2) When populating a db, the program assumes that every device that it finds with a log for today has a logging 
 ##    frequency of 1.  This will usually be true, but will occationally cause a device to erroneously be flagged as 
 ##    "Not Logging".  This should be smoothed out automatically after a few weeks.
@@ -43,11 +46,26 @@
 import os 
 import re         # For pattern matching
 import sys
-import glob       # For manipulating filenames
+import atexit     # For writing back and releasing the run lock on exit
+import fcntl      # For the run lock
+import cProfile   # For profiling the phases of a run
+import gzip       # For reading compressed manifests
+import json       # For storing directory snapshots in the database
+import hashlib    # For the ETags of the status server
+import http.server        # For the status server
+import socketserver       # For answering status requests in threads
+import threading  # For sharing the status index between server threads
+import urllib.parse       # For reading device names from status requests
 import signal     # Allows for graceful exit on CTRL+C
 import getopt     # For capturing command line arguments
+import multiprocessing    # For reading the log tree in parallel when populating
 import dbinit     # Custom module, initialize the database
 import datetime   # For timestamps
+import statistics # For the rolling median of log volume
+import subprocess # For handing CEF messages to the logger
+import tarfile    # For reading the member headers of log archives
+import time       # For measuring the cost of scan phases
+import tracemalloc        # For finding where a phase allocates memory
 import sqlite3 as lite    # For database access
 from math import ceil     # Get rid of decimals
 
@@ -62,14 +80,129 @@ pathToOpLog = "/path/to/logtracker/execution/logs/directory"
 pathToDB = "/path/to/logtracker.db"
 opLogName = "logTracker.log"
 reportFileName = "logTrackerReport_"+ str(datetime.datetime.now()).split(".")[0].replace(" ","_").replace(":",".")
+eventReportFileName = "logTrackerEvents_"+ str(datetime.datetime.now()).split(".")[0].replace(" ","_").replace(":",".")
+# Number of days of device events to keep in the database
+eventRetentionDays = 400
+# Routine events sent for every device on every run.  These are only counted per day, the other events and the errors
+# are stored one by one
+eventSummaryCodes = (0, 1, 2)
+# Directory layouts used to discover new devices.  {root} is logDirPath, {device} is the device directory and {date} is
+# the YYYY-MM-DD directory.  Any other {name} matches any single directory and plain text must match exactly.  Scanning
+# stops at the {date} level, so anything after it is ignored.  If no template matches a directory it is walked in full
+# when layoutFallbackWalk is True
+layoutTemplates = ["{root}/{device}/{date}/*", "{root}/{site}/{device}/{date}/*"]
+layoutFallbackWalk = True
+# Remember directories that were searched without finding any devices and skip them until they change
+discoveryCache = True
+# Collect the number and size of the files in today's directory of each device.  CEF 7 is sent when a device logs less
+# than volumeDropFraction of the median of its last volumeWindow days, once it has at least volumeMinSamples days
+volumeTelemetry = False
+volumeDropFraction = 0.1
+volumeWindow = 14
+volumeMinSamples = 3
+# Only one copy of the program runs at a time.  A run that finds the lock held by a process older than lockStaleSeconds
+# reports it, but a live holder is never replaced.  Audit results are committed every checkpointBatch devices so an
+# interrupted audit can resume
+lockFileName = "logtracker.lock"
+lockStaleSeconds = 6 * 3600
+checkpointBatch = 500
+# Number of seconds an audit may spend checking devices before it stops and leaves the rest for the next audit.
+# 0 means no limit.  Set with -d
+auditDeadline = 0
+# Work on an in-memory copy of the database and write it back to pathToDB, through a temporary file and a rename, when
+# the connection is closed or the program exits, and after a commit once dbPersistSeconds have passed since the last
+# write.  With dbJournal, every committed change is also appended to pathToDB.journal so that it survives a crash
+# before the next write back.  The in-memory copy can also be turned on with --memory
+dbInMemory = False
+dbPersistSeconds = 300
+dbJournal = False
+# Run the audit again every auditEvery seconds instead of exiting, keeping the database in memory between audits when
+# dbInMemory is set.  The run lock is released between audits.  0 runs a single audit.  Set with --every
+auditEvery = 0
+# Number of devices inserted per transaction when populating a new database
+populateChunkSize = 1000
+# Number of worker processes that read the top level directories of the log tree when populating.  1 reads them in
+# this process.  Set with --workers
+populateWorkers = 1
+# Count the days held in rotated and compressed log archives, e.g. messages-2024-01-31.gz or 2024-01.tar.gz, found in a
+# device directory.  Days come from the archive's file name, and for tar archives from the names or mtimes in the
+# member headers.  The days are cached per archive until its size or mtime changes
+archiveIndexing = True
+archiveExtensions = (".gz", ".bz2", ".xz", ".tar", ".tgz")
+# Address of the read-only JSON status server started with --serve.  The database is checked for changes at most once
+# every serveCheckSeconds
+serveHost = "127.0.0.1"
+servePort = 8514
+serveCheckSeconds = 1
+# Profiling with --profile writes a .pstats file and the profileTopAllocations largest allocation sites, traced
+# profileFrames deep, for every phase of the run into pathToOpLog.  --profile-sample instead records the stack every
+# profileSampleInterval seconds into a .folded file per phase, which is cheap enough to leave on
+profileTopAllocations = 25
+profileFrames = 1
+profileSampleInterval = 0.01
+# Every filesystem read goes through an I/O governor so audits don't starve the collectors writing the logs.
+# ioRateLimit caps the reads and stats per second, with bursts of up to ioBurst, 0 means no cap.  While checking
+# devices, their directories are read ahead by up to ioMaxConcurrency threads.  The number of reads allowed at once
+# starts at 1, grows while directory reads take less than ioLatencyTarget seconds, and is multiplied by ioBackoff when
+# they take longer.  Only the read-ahead adds parallel reads; discovery and populate read one directory at a time, so
+# for them the governor only applies the rate cap.  When populating with worker processes, each worker has its own
+# governor and the rate is split between them
+ioRateLimit = 0
+ioBurst = 50
+ioMaxConcurrency = 8
+ioLatencyTarget = 0.05
+ioBackoff = 0.5
+# CEF messages are written to an outbox of segment files in pathToOpLog/outboxDirName, one sequential write per batch,
+# and handed to pathLogger from there by a thread while the run lasts, or with --drain.  Each segment holds about
+# outboxSegmentBytes.  Once the outbox holds outboxMaxBytes, routine messages (1 and 2) are dropped until it drains.
+# At exit, what the logger accepts straight away is delivered for up to outboxDrainSeconds and the rest is left for the
+# next run, without retrying a logger that refuses messages
+outboxEnabled = True
+outboxDirName = "cef-outbox"
+outboxSegmentBytes = 1024 * 1024
+outboxMaxBytes = 100 * 1024 * 1024
+outboxRetrySeconds = 30
+outboxSendTimeout = 10
+outboxDrainSeconds = 60
 #
 # Don't modify these variables 
 devicesNew = []
 devicesNotLogging = []
+eventBuffer = []
+eventCounts = {}
+layoutsCompiled = None
+manifestPath = None
+manifestTree = None
+dirCache = None
+dirPending = {}
+dirLock = threading.Lock()
+lockFd = None
+rootId = None
+rootPaths = {}
+auditRunning = False
+stopRequested = False
+runMetrics = {}
+archiveIndex = {}
+archiveUpdates = {}
+phaseStack = []
+phaseHeld = {}
+profileMode = None
+profileRun = None
+profileCount = 0
+profileSampler = None
+ioGovernor = None
+outboxBuffer = []
+outboxDrainer = None
+backfillDone = False
+dbMemory = None
+dbScratch = False
+cefDryRun = False
+asOf = None
 dateToday = str(datetime.date.today())
 hourNow = int(getattr(datetime.datetime.now(), 'hour'))
 ptrnDateSubDir = '/[0-9]{4}-[0-9]{2}-[0-9]{2}'
 ptrnDateRecalcFreq = '[0-9]{4}-[0-9]{2}-[0-9]{2}'
+ptrnDateArchive = '(?<![0-9])([0-9]{4})-?([0-9]{2})-?([0-9]{2})(?![0-9])'
 if hourNow == 0:
     hourPrev = 23
 else:
@@ -77,7 +210,9 @@ else:
 
 ### Database variables ###
 # Table 'devices' structure
-# dev_name TEXT, first_see TEXT, last_seen TEXT, freq INT, crit_sys INT, inactive INT, inactive_date INT, dev_id INT PK
+# dev_name TEXT, first_see TEXT, last_seen TEXT, freq INT, crit_sys INT, inactive INT, inactive_date INT, dev_id INT PK,
+# root_id INT.  dev_name is relative to logDirPath, whose root_id is in the 'roots' table.  Devices found outside
+# logDirPath keep their full path and have no root_id
 tbl_devs = 'devices'
 col_dname = 'dev_name'
 col_fseen = 'first_seen'
@@ -89,6 +224,7 @@ col_idate = 'inactive_date'
 col_nlog = 'not_log'
 col_nldate = 'notlog_date'
 col_devid = 'dev_id'
+col_rootid = 'root_id'
 
 ### Text blocks ###
 # Help text
@@ -115,12 +251,49 @@ helpText+= "                    with the devices it finds.  If a device has no l
 helpText+= "                    old it is set to Inactive.  Devices with current logs under 'today', its requency will \n"
 helpText+= "                    be set to 1, otherwise the frequency will be calculated and set.  This will fail if a database\n"
 helpText+= "                    already exists in the specified path\n"
+helpText+= "      --workers=    With -p, read the top level directories of the log tree with the given number of worker\n"
+helpText+= "                    processes.  The database is the same as with a single process\n"
 helpText+= "  -r  --report      Generate a report containing the devices that are not logging, critical systems, or are inactive. \n"
+helpText+= "      --since=      With -r, report on the device events between the given dates instead of running an audit.\n"
+helpText+= "      --until=      Dates are YYYY-MM-DD.  --until defaults to today and --since to 30 days before --until.  The\n"
+helpText+= "                    report lists event counts, devices that flapped, and the time to recover for critical systems\n"
+helpText+= "  -d  --deadline=   Stop checking devices after the given number of seconds.  Devices are checked in order of\n"
+helpText+= "                    priority: critical systems, devices left over by the last audit, then the devices most\n"
+helpText+= "                    overdue or closest to being due.  Devices not checked in time are checked first next run\n"
+helpText+= "      --drain       Deliver the CEF messages left in the outbox by earlier runs, then exit\n"
+helpText+= "      --serve       Serve the device status as JSON on http://"+ serveHost +":"+ str(servePort) +" until stopped, at\n"
+helpText+= "                    /device/<name>, /overdue, /critical and /stats.  Responses carry an ETag and the status\n"
+helpText+= "                    is read again whenever the database changes\n"
+helpText+= "      --profile     Profile each phase of the run with cProfile and tracemalloc.  A .pstats file and the top\n"
+helpText+= "                    allocation sites for every phase are written to the operations log directory\n"
+helpText+= "      --profile-sample  Sample the running code instead, writing a .folded stack file for every phase.  Cheap\n"
+helpText+= "                    enough to leave on\n"
+helpText+= "      --backfill    Before auditing, catch up on the days missed since the last audit finished.  Each device's\n"
+helpText+= "                    directory is read once for all of the missed days\n"
+helpText+= "      --memory      Load the database into memory for the run and write it back at the end\n"
+helpText+= "      --every=      Keep running and audit again every given number of seconds.  The run lock is released between\n"
+helpText+= "                    audits.  With --memory the database stays in memory, is written back after each audit, and\n"
+helpText+= "                    is loaded again if another run changes it\n"
+helpText+= "  -m  --manifest=   Read the log directory structure from a manifest file instead of the log filesystem.  Takes the\n"
+helpText+= "                    path to a text file, optionally gzipped, with one device/date or device/date/hour path per line,\n"
+helpText+= "                    relative to the logging directory or absolute.  Can be combined with the other options, e.g. -m\n"
+helpText+= "                    manifest.gz -p, to audit or populate from a snapshot without touching the log filesystem.  The\n"
+helpText+= "                    run uses a scratch copy of the database and only logs the CEF messages it would send\n"
+helpText+= "      --live        With -m, write the results to the database and send the CEF messages\n"
+helpText+= "      --as-of=      Treat the given day, YYYY-MM-DD, as today, e.g. to replay the manifest of a past day.  The hour\n"
+helpText+= "                    is the last of the day unless given as YYYY-MM-DDTHH\n"
 ######################################################################################################################
 ### Function definitions ###
 
 # Capture CTRL+C and exit gracefully
+# During an audit the first signal only asks the audit to save the devices checked so far and stop
 def signal_handler(signal, fram):
+    global stopRequested
+    if auditRunning and not stopRequested:
+        stopRequested = True
+        log("[!] Stop requested. Saving the devices checked so far\n")
+        print("\n[!] Stop requested. Saving the devices checked so far")
+        return
     log("[!] CTRL+C pressed. Exiting")
     print("\n[!] CTRL+C pressed. Exiting")
     raise SystemExit
@@ -138,9 +311,241 @@ def log(logLine):
 # 4 = Device has been set to inactive due to prolonged inactivity
 # 5 = Device has resumed logging and had its "not logging" bit flipped
 # 6 = Device is new and added to the database
+# 7 = Device is logging, but its log volume has dropped below volumeDropFraction of its rolling median
 # 100 = An error has occurred
-def cefMsg(devName,num):
-    os.system(pathLogger +" \"CEF:0|HFT Infosec|HFT-Infosec-Utils|1.0|0|Asset-Logging-Status|3|msg="+ devName +" "+ str(num) +" cs1Label='Device Name' cs1=" + devName + " cs2Label='Event Number' cs2="+ str(num) + "\"")
+# The messages go through the outbox, written in batches by eventsFlush().  Errors are written out immediately
+# The event is stored for today, or for the datetime date object passed as day when it happened on an earlier day
+def cefMsg(devName,num,day=None):
+    day = (day or dateNow()).toordinal()
+    if num in eventSummaryCodes:
+        eventCounts[(num, day)] = eventCounts.get((num, day), 0) + 1
+    else:
+        eventBuffer.append((devRelName(devName), num, day))
+    if cefDryRun:
+        log("[-] CEF not sent, dry run: "+ cefString(devName, num) +"\n")
+        return
+    if not outboxEnabled:
+        cefSend(cefString(devName, num))
+        return
+    outboxBuffer.append((num, cefString(devName, num)))
+    if num == 100:
+        outboxFlush()
+
+# Build the CEF string for a device event
+# Takes a string of the device name and the event number as arguments
+# Returns the CEF string
+def cefString(devName, num):
+    return "CEF:0|HFT Infosec|HFT-Infosec-Utils|1.0|0|Asset-Logging-Status|3|msg="+ devName +" "+ str(num) +" cs1Label='Device Name' cs1=" + devName + " cs2Label='Event Number' cs2="+ str(num)
+
+# Hand a CEF string to the logger
+# Takes the CEF string as an argument
+# Returns True if the logger accepted it, else False
+def cefSend(cef):
+    try:
+        return subprocess.run([pathLogger, cef], timeout=outboxSendTimeout).returncode == 0
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+# Get the sequence numbers of the outbox segment files, oldest first
+# Returns a list of integers
+def outboxSegments():
+    try:
+        return sorted([int(name[4:-4]) for name in os.listdir(outboxPath()) if re.match("seg-[0-9]+\\.cef$", name)])
+    except OSError:
+        return []
+
+# Takes an integer segment sequence number as an argument
+# Returns the path of the segment file
+def outboxSegmentPath(seq):
+    return outboxPath() +"/seg-"+ str(seq).zfill(12) +".cef"
+
+# Returns the path of the outbox directory
+def outboxPath():
+    return pathToOpLog +"/"+ outboxDirName
+
+# Read the position of the first message that has not been delivered
+# Returns a list of the segment sequence number and the byte offset in it
+def outboxAckRead():
+    try:
+        with open(outboxPath() +"/ack") as ackFile:
+            return [int(x) for x in ackFile.read().split()[:2]]
+    except (OSError, ValueError):
+        return [0, 0]
+
+# Record the position of the first message that has not been delivered
+# Takes the segment sequence number and the byte offset as arguments
+def outboxAckWrite(seq, offset):
+    with open(outboxPath() +"/ack.tmp", "w") as ackFile:
+        ackFile.write(str(seq) +" "+ str(offset) +"\n")
+    os.replace(outboxPath() +"/ack.tmp", outboxPath() +"/ack")
+
+# Append the buffered CEF messages to the outbox with one write.  Once the outbox holds outboxMaxBytes, routine
+# "is logging" and "not yet overdue" messages are dropped so the status changes and errors still fit.  If the outbox
+# can't be written, e.g. because pathToOpLog is missing, the messages are sent straight to the logger instead
+def outboxFlush():
+    global outboxBuffer
+    if not outboxBuffer:
+        return
+    lines = outboxBuffer
+    outboxBuffer = []
+    counters = runMetrics.setdefault("outbox", {"queued": 0, "dropped": 0, "delivered": 0, "retries": 0, "direct": 0})
+    try:
+        # pathToOpLog itself is not created, a missing one means the messages can't be kept
+        if not os.path.isdir(outboxPath()):
+            os.mkdir(outboxPath())
+        segs = outboxSegments()
+        sizes = [os.path.getsize(outboxSegmentPath(seq)) for seq in segs]
+        if sum(sizes) >= outboxMaxBytes:
+            kept = [line for num, line in lines if num not in (1, 2)]
+            counters["dropped"] += len(lines) - len(kept)
+        else:
+            kept = [line for num, line in lines]
+        if not kept:
+            return
+        seq = segs[-1] if segs else max(outboxAckRead()[0], 1)
+        if segs and sizes[-1] >= outboxSegmentBytes:
+            seq += 1
+        data = "".join([line +"\n" for line in kept]).encode()
+        fd = os.open(outboxSegmentPath(seq), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o640)
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        counters["queued"] += len(kept)
+    except OSError as e:
+        # The operations log lives next to the outbox and may be just as unwritable
+        try:
+            log("[!] Failed to write to the CEF outbox, sending "+ str(len(lines)) +" messages directly\n[!] Error: "+ str(e) +"\n")
+        except OSError:
+            pass
+        for num, line in lines:
+            cefSend(line)
+        counters["direct"] += len(lines)
+        return
+    if lockFd is not None:
+        outboxDrainerStart()
+        outboxDrainer[1].set()
+
+# Deliver the messages in the outbox in order, recording each one as delivered once the logger accepts it.  A message
+# the logger refuses is retried with a growing delay of up to outboxRetrySeconds.  Delivered segments are removed
+# With a deadline, as at exit, a refused message is not retried and delivery stops once the deadline passes
+# Takes a threading.Event that stops the delivery, and optionally a deadline in seconds since the epoch, as arguments
+# Returns True if the outbox is empty, else False
+def outboxDrain(stop, deadline=None):
+    counters = runMetrics.setdefault("outbox", {"queued": 0, "dropped": 0, "delivered": 0, "retries": 0, "direct": 0})
+    seq, offset = outboxAckRead()
+    while not stop.is_set():
+        segs = [s for s in outboxSegments() if s >= seq]
+        if not segs:
+            return True
+        if segs[0] != seq:
+            seq, offset = segs[0], 0
+        try:
+            with open(outboxSegmentPath(seq), "rb") as segFile:
+                segFile.seek(offset)
+                data = segFile.read()
+        except OSError as e:
+            log("[!] Failed to read the CEF outbox\n[!] Error: "+ str(e) +"\n")
+            return False
+
+        # Only whole lines are delivered, a batch may still be being written
+        for line in data[:data.rfind(b"\n") + 1].splitlines(True):
+            if deadline and time.time() >= deadline:
+                return False
+            delay = 1
+            while not cefSend(line.decode().rstrip("\n")):
+                if deadline or stop.wait(delay):
+                    return False
+                counters["retries"] += 1
+                delay = min(delay * 2, outboxRetrySeconds)
+            offset += len(line)
+            outboxAckWrite(seq, offset)
+            counters["delivered"] += 1
+
+        # Remove the segment once it is delivered and a newer one has been started
+        if len(segs) > 1:
+            try:
+                os.remove(outboxSegmentPath(seq))
+            except OSError:
+                pass
+            seq, offset = segs[1], 0
+            outboxAckWrite(seq, offset)
+        else:
+            return True
+    return False
+
+# Start the thread that delivers the outbox during the run.  Only the process holding the run lock delivers
+def outboxDrainerStart():
+    global outboxDrainer
+    if outboxDrainer:
+        return
+    stop = threading.Event()
+    wake = threading.Event()
+
+    def drain():
+        while not stop.is_set():
+            wake.wait(1)
+            wake.clear()
+            outboxDrain(stop)
+
+    outboxDrainer = [threading.Thread(target=drain, daemon=True), wake, stop]
+    outboxDrainer[0].start()
+    atexit.register(outboxClose)
+
+# Write any buffered messages, stop the drainer, and deliver what the logger accepts straight away for up to
+# outboxDrainSeconds.  The run never waits on a logger that refuses messages, whatever is left stays in the outbox for
+# the next run or --drain
+def outboxClose():
+    global outboxDrainer
+    outboxFlush()
+    if not outboxDrainer:
+        return
+    thread, wake, stop = outboxDrainer
+    stop.set()
+    wake.set()
+    thread.join()
+    outboxDrainer = None
+    outboxDrain(threading.Event(), time.time() + outboxDrainSeconds)
+    log("[+] Delivered "+ str(runMetrics["outbox"]["delivered"]) +" CEF messages from the outbox this run\n")
+    left = outboxPending()
+    if left:
+        log("[!] "+ str(left) +" CEF messages are still in the outbox and will be sent by the next run or --drain\n")
+
+# Count the messages in the outbox that have not been delivered
+# Returns an integer
+def outboxPending():
+    seq, offset = outboxAckRead()
+    pending = 0
+    for s in outboxSegments():
+        if s < seq:
+            continue
+        try:
+            with open(outboxSegmentPath(s), "rb") as segFile:
+                if s == seq:
+                    segFile.seek(offset)
+                pending += segFile.read().count(b"\n")
+        except OSError:
+            continue
+    return pending
+
+# Deliver everything in the outbox, retrying for up to outboxDrainSeconds while the logger refuses messages
+def outboxDrainAll():
+    log("[-] Draining "+ str(outboxPending()) +" messages from the CEF outbox\n")
+    stop = threading.Event()
+    timer = threading.Timer(outboxDrainSeconds, stop.set)
+    timer.start()
+    try:
+        done = outboxDrain(stop)
+    finally:
+        timer.cancel()
+    counters = runMetrics.get("outbox", {})
+    log("[+] Delivered "+ str(counters.get("delivered", 0)) +" messages with "+ str(counters.get("retries", 0)) +" retries\n")
+    if not done:
+        log("[!] "+ str(outboxPending()) +" messages could not be delivered and are still in the outbox\n\n")
+        print("[!] Some CEF messages could not be delivered.  Check the log for more details\n")
+    else:
+        log("[+] The CEF outbox is empty\n\n")
 
 # Start ops log
 def logStart():
@@ -159,6 +564,92 @@ def logStart():
         cefMsg("DB Error",100)
         raise SystemExit
 
+# Take the exclusive run lock.  The lock is an flock on the lock file, so the kernel drops it when the holder exits and
+# a lock left behind by a dead process never blocks a run
+# Takes True as an argument to wait for another copy of the program to finish, as --every does between audits
+# Quits if another copy of the program is running and wait is not set
+def lockAcquire(wait=False):
+    global lockFd
+    lockPath = pathToOpLog +"/"+ lockFileName
+    fd = os.open(lockPath, os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        if wait:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                log("[-] Another copy of logtracker is running, waiting for it to finish\n")
+                fcntl.flock(fd, fcntl.LOCK_EX)
+        else:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        holder = os.read(fd, 64).decode(errors="replace").split()
+        os.close(fd)
+        log("[!] Another copy of logtracker is running, see "+ lockPath +"\n")
+        # A holder that is still alive is never replaced, but one that has run for too long is worth reporting
+        try:
+            if time.time() - int(holder[1]) > lockStaleSeconds:
+                log("[!] Process "+ holder[0] +" has held the run lock for more than "+ str(lockStaleSeconds) +" seconds\n")
+        except (IndexError, ValueError):
+            pass
+        log("[!] Exiting\n\n")
+        cefMsg("Lock Error",100)
+        print("\n[!] Another copy of logtracker is running\n[!] Please check the log for details\n[!] Quitting\n\n")
+        raise SystemExit
+    os.ftruncate(fd, 0)
+    os.write(fd, (str(os.getpid()) +" "+ str(int(time.time())) +"\n").encode())
+    lockFd = fd
+    log("[+] Run lock acquired\n")
+
+# Release the run lock if this process holds it.  The lock file is left in place, removing it would let a second copy
+# lock a new file while a third still waits on the old one
+def lockRelease():
+    global lockFd
+    if lockFd is None:
+        return
+    try:
+        os.ftruncate(lockFd, 0)
+        fcntl.flock(lockFd, fcntl.LOCK_UN)
+        os.close(lockFd)
+    except OSError:
+        pass
+    lockFd = None
+
+# Get the time the program treats as now.  --as-of moves it to a past day, e.g. to replay the manifest of that day
+# Returns a datetime.datetime object
+def timeNow():
+    if asOf is not None:
+        return asOf
+    return datetime.datetime.now()
+
+# Returns a datetime.date object of the day the program treats as today.  See timeNow()
+def dateNow():
+    return timeNow().date()
+
+# Get the full path of a device from its name in the database.  Relative names are resolved against the root_path of
+# the device's root_id, or against logDirPath for names that are not from a database row
+# Takes a string of the device name and optionally its root_id as arguments
+# Returns a string of the device path
+def devAbsPath(name, root=None):
+    if name.startswith("/"):
+        return name
+    return rootPaths.get(root, logDirPath) +"/"+ name
+
+# Get the name stored in the database for a device path.  Paths under logDirPath are stored relative to it
+# Takes a string of the device path as an argument
+# Returns a string of the device name
+def devRelName(path):
+    if path.startswith(logDirPath +"/"):
+        return path[len(logDirPath) + 1:]
+    return path
+
+# Get the root_id to store for a device path
+# Takes a string of the device path as an argument
+# Returns the root_id of logDirPath, or None if the device is outside it
+def devRoot(path):
+    if path.startswith(logDirPath +"/"):
+        return rootId
+    return None
+
 # Sanitize directory names
 # Returns the passed string leaving only a-z, A-Z, 0-9, /, ., and -
 def cleanDirName(devName):
@@ -240,7 +731,7 @@ def checkLogFrequency(devStats):
     # Create datetime object from last_seen date devStats[2], compare with today's date, check against average logging frequency devStats[3]
     try:
         lseen = datetime.date(int(devStats[2].split('-')[0]), int(devStats[2].split('-')[1]), int(devStats[2].split('-')[2]))
-        today = datetime.date.today()
+        today = dateNow()
         logFreq = datetime.timedelta(days=devStats[3])
     except:
         log("[!] Logging frequency comparison failed\n[!] Error: "+ str(sys.exc_info()[1]) +"\n[!] Exiting\n\n")
@@ -256,6 +747,7 @@ def checkLogFrequency(devStats):
 # Collect device names with various statuses and feed them to the reportPrint() function:
 # Takes a sqlite3 cursor object and two lists of strings as arguments
 def reportMake():
+    phaseBegin("report")
     log("[-] Report data collection beginning\n")
     Y = 1
     devInact = []
@@ -284,7 +776,7 @@ def reportMake():
     for dev in allDevs:
         if dev[4]:
             d = []
-            d.append(dev[0])
+            d.append(devAbsPath(dev[0], dev[10]))
             if dev[5]:
                 d.append("INACTIVE")
             else:
@@ -295,15 +787,16 @@ def reportMake():
                 d.append("LOGGING")
             devCrit.append(d)
         elif not dev[5] and dev[7]:
-            devNotLog.append(dev[0])
+            devNotLog.append(devAbsPath(dev[0], dev[10]))
         else:
-            devInact.append(dev[0])
+            devInact.append(devAbsPath(dev[0], dev[10]))
     log("[+][+] There are "+ str(len(devCrit)) +" Critical devices\n")
     log("[+][+] There are "+ str(len(devNotLog)) +" active devices that are not logging\n")
     log("[+][+] There are "+ str(len(devInact)) +" inactive devices\n")
 
     # Print the report
     reportPrint(devCrit, devNotLog, devInact)
+    phaseEnd()
     
 # Print the report to a text file. It takes 5 lists of strings as arguments
 # Creates the text document in the logging directory
@@ -359,6 +852,267 @@ def reportPrint(devCrit, devNotLog, devInact):
         print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
         raise SystemExit
 
+# Write the device events collected by cefMsg() since the last call into the events table, and add the routine ones
+# to the daily counts in event_counts.  Does not commit
+# Takes a sqlite3 database cursor as an argument
+def eventsWrite(dbc):
+    dbc.executemany("INSERT INTO events (dev_name, code, day) VALUES (?, ?, ?)", eventBuffer)
+    dbc.executemany("INSERT OR IGNORE INTO event_counts (code, day, count) VALUES (?, ?, 0)", list(eventCounts))
+    dbc.executemany("UPDATE event_counts SET count = count + ? WHERE code = ? AND day = ?", [(n, k[0], k[1]) for k, n in eventCounts.items()])
+    del eventBuffer[:]
+    eventCounts.clear()
+
+# Write the device events to the database after writing their CEF messages to the outbox.  Does not commit
+# Takes a sqlite3 database cursor as an argument
+def eventsFlush(dbc):
+    outboxFlush()
+    try:
+        eventsWrite(dbc)
+    except lite.Error as e:
+        log("[!] Failed to save the device events\n[!] Error: "+ str(e) +"\n[!] Exiting\n\n")
+        cefMsg("Query Error",100)
+        print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
+        raise SystemExit
+
+# Save the events still buffered when the program exits, such as those of a populate, a report, or a run stopped by an
+# error.  Runs after the in-memory database has been written back, so it writes to the database file.  Nothing is
+# saved by a scratch run
+def eventsSave():
+    if not (eventBuffer or eventCounts) or dbScratch or not os.path.isfile(pathToDB):
+        return
+    try:
+        dbconn = lite.connect(pathToDB, timeout=1)
+        eventsWrite(dbconn.cursor())
+        dbconn.commit()
+        dbconn.close()
+    except lite.Error as e:
+        log("[!] Failed to save the device events at exit\n[!] Error: "+ str(e) +"\n")
+
+# Report on the device events between two dates: the number of each event, including the routine ones counted per day, the devices that stopped or resumed logging
+# more than once, and the average number of days critical systems took to resume logging
+# Takes two datetime date objects as arguments
+def eventReport(since, until):
+    log("[-] Event report for "+ str(since) +" to "+ str(until) +" beginning\n")
+    first = since.toordinal()
+    last = until.toordinal()
+    dbconn = dbMakeConnection(pathToDB)
+    dbc = dbMakeCursor(dbconn)
+    try:
+        dbc.execute("SELECT code, SUM(n) FROM (SELECT code, COUNT(*) AS n FROM events WHERE day BETWEEN ? AND ? GROUP BY code UNION ALL "\
+        "SELECT code, SUM(count) FROM event_counts WHERE day BETWEEN ? AND ? GROUP BY code) GROUP BY code ORDER BY code", (first, last, first, last))
+        codeCounts = dbc.fetchall()
+        dbc.execute("SELECT dev_name, COUNT(*) FROM events WHERE code IN (3, 5) AND day BETWEEN ? AND ? GROUP BY dev_name HAVING COUNT(*) > 1 ORDER BY COUNT(*) DESC, dev_name", (first, last))
+        devFlap = dbc.fetchall()
+        dbc.execute("SELECT {dn} FROM {tn} WHERE {cs} = 1".format(dn=col_dname, tn=tbl_devs, cs=col_crit))
+        devCrit = set([r[0] for r in dbc.fetchall()])
+        dbc.execute("SELECT dev_name, code, day FROM events WHERE code IN (3, 5) AND day BETWEEN ? AND ? ORDER BY dev_name, day, rowid", (first, last))
+        transitions = dbc.fetchall()
+    except lite.Error as e:
+        log("[!] Failed to get the device events\n[!] Error: "+ str(e) +"\n[!] Exiting\n\n")
+        cefMsg("Query Error",100)
+        print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
+        raise SystemExit
+    dbconn.close()
+
+    # Pair each critical system's "not logging" event with the next "resumed logging" event
+    recoveries = []
+    stillDown = []
+    downSince = {}
+    for dev, code, day in transitions:
+        if dev not in devCrit:
+            continue
+        if code == 3:
+            downSince.setdefault(dev, day)
+        elif dev in downSince:
+            recoveries.append(day - downSince.pop(dev))
+    stillDown = sorted(downSince)
+
+    body = "\n\n-----==== "+ eventReportFileName +" ====-----\n"
+    body+= "Events from "+ str(since) +" to "+ str(until) +"\n\n"
+    body+= "--------------------------------------------------------\n"
+    body+= "[BEGIN EVENT COUNTS]\n"
+    for code, count in codeCounts:
+        body+= "CEF "+ str(code) +": "+ str(count) +"\n"
+    body+= "[END EVENT COUNTS]\n"
+    body+= "--------------------------------------------------------\n"
+    if devFlap:
+        body+= "[BEGIN FLAPPING DEVICES]\n"
+        body+= "Total: "+ str(len(devFlap)) +"\n"
+        for dev, count in devFlap:
+            body+= devAbsPath(dev) +" "+ str(count) +" changes\n"
+        body+= "[END FLAPPING DEVICES]\n"
+    else:
+        body+= "[THERE ARE NO FLAPPING DEVICES]\n"
+    body+= "--------------------------------------------------------\n"
+    body+= "[BEGIN CRITICAL SYSTEM RECOVERY]\n"
+    body+= "Recoveries: "+ str(len(recoveries)) +"\n"
+    if recoveries:
+        body+= "Mean days to recover: "+ str(round(sum(recoveries) / len(recoveries), 1)) +"\n"
+    body+= "Still not logging: "+ str(len(stillDown)) +"\n"
+    for dev in stillDown:
+        body+= devAbsPath(dev) +"\n"
+    body+= "[END CRITICAL SYSTEM RECOVERY]\n"
+    body+= "--------------------------------------------------------\n"
+
+    try:
+        with open(pathToOpLog+"/"+eventReportFileName, "w") as logFile:
+            logFile.write(body)
+    except:
+        log("[!] Failed to write the event report\n[!] Error: "+ str(sys.exc_info()[1]) +"\n[!] Exiting\n\n")
+        cefMsg("Report Error",100)
+        print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
+        raise SystemExit
+    log("[+] Event report written to "+ eventReportFileName +"\n")
+
+# In-memory index of device status for the status server.  Rebuilt from the database whenever another connection
+# commits a change, which sqlite3 reports through PRAGMA data_version, or the database file is replaced
+class StatusIndex:
+    def __init__(self, dbPath):
+        self.dbPath = dbPath
+        self.lock = threading.Lock()
+        self.conn = None
+        self.fileId = None
+        self.dataVersion = None
+        self.checkedAt = 0
+        self.devices = {}
+        self.bodies = {}
+
+    # Open a read-only connection to the database
+    def connect(self):
+        if self.conn:
+            self.conn.close()
+        self.conn = lite.connect("file:"+ self.dbPath +"?mode=ro", uri=True, check_same_thread=False)
+        self.dataVersion = None
+
+    # Rebuild the index if the database has changed.  Checked at most once every serveCheckSeconds
+    def refresh(self):
+        with self.lock:
+            now = time.time()
+            if self.conn and now - self.checkedAt < serveCheckSeconds:
+                return
+            self.checkedAt = now
+
+            # The in-memory database is written back by replacing the file, which the open connection would not see
+            st = os.stat(self.dbPath)
+            if (st.st_ino, st.st_mtime_ns) != self.fileId:
+                self.fileId = (st.st_ino, st.st_mtime_ns)
+                self.connect()
+            dataVersion = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            if dataVersion == self.dataVersion:
+                return
+            self.build()
+            self.dataVersion = dataVersion
+
+    # Read every device into the index and prepare the bodies of the list endpoints
+    def build(self):
+        rows = self.conn.execute("SELECT dev_name, first_seen, last_seen, freq, crit_sys, inactive, inactive_date, not_log, notlog_date, dev_id, root_id FROM {tn}"\
+        .format(tn=tbl_devs)).fetchall()
+        rootPaths.update(self.conn.execute("SELECT root_id, root_path FROM roots").fetchall())
+        devices = {}
+        for r in rows:
+            devices[r[0]] = {"name": r[0], "path": devAbsPath(r[0], r[10]), "first_seen": r[1], "last_seen": r[2], "freq": r[3],\
+            "critical": bool(int(r[4] or 0)), "inactive": bool(int(r[5] or 0)), "inactive_date": r[6],\
+            "not_logging": bool(int(r[7] or 0)), "notlog_date": r[8], "dev_id": r[9]}
+        overdue = sorted([d for d in devices.values() if d["not_logging"] and not d["inactive"]], key=lambda d: (d["last_seen"] or "", d["name"]))
+        critical = sorted([d for d in devices.values() if d["critical"]], key=lambda d: d["name"])
+        stats = {"devices": len(devices),
+                 "active": len([d for d in devices.values() if not d["inactive"]]),
+                 "inactive": len([d for d in devices.values() if d["inactive"]]),
+                 "not_logging": len(overdue),
+                 "critical": len(critical),
+                 "critical_not_logging": len([d for d in critical if d["not_logging"] and not d["inactive"]]),
+                 "indexed_at": datetime.datetime.now().replace(microsecond=0).isoformat()}
+        self.devices = devices
+        self.bodies = {"/overdue": statusBody({"total": len(overdue), "devices": overdue}),
+                       "/critical": statusBody({"total": len(critical), "devices": critical}),
+                       "/stats": statusBody(stats)}
+        log("[+] Status index rebuilt with "+ str(len(devices)) +" devices\n")
+
+    # Get the JSON body and ETag for a request path
+    # Returns a list of the HTTP status code, the body, and the ETag
+    def lookup(self, path):
+        with self.lock:
+            if path in self.bodies:
+                return [200] + self.bodies[path]
+            if path.startswith("/device/"):
+                name = devRelName(urllib.parse.unquote(path[len("/device/"):]).rstrip("/"))
+                if name in self.devices:
+                    key = "/device/"+ name
+                    if key not in self.bodies:
+                        self.bodies[key] = statusBody(self.devices[name])
+                    return [200] + self.bodies[key]
+                return [404] + statusBody({"error": "unknown device", "name": name})
+        return [404] + statusBody({"error": "unknown path", "paths": ["/device/<name>", "/overdue", "/critical", "/stats"]})
+
+# Encode a status response as JSON and tag it
+# Takes a dictionary or list as an argument
+# Returns a list of the body bytes and the ETag
+def statusBody(data):
+    body = json.dumps(data, sort_keys=True).encode()
+    return [body, '"'+ hashlib.sha1(body).hexdigest()[:20] +'"']
+
+# Answers GET requests to the status server from the shared StatusIndex
+class StatusHandler(http.server.BaseHTTPRequestHandler):
+    index = None
+
+    def do_GET(self):
+        try:
+            self.index.refresh()
+            code, body, etag = self.index.lookup(urllib.parse.urlsplit(self.path).path)
+        except (lite.Error, OSError) as e:
+            log("[!] Status server failed to read the database\n[!] Error: "+ str(e) +"\n")
+            code, body, etag = [503] + statusBody({"error": "database unavailable"})
+        if code == 200 and etag in [t.strip() for t in self.headers.get("If-None-Match", "").split(",")]:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Requests are not written to the operations log
+    def log_message(self, format, *args):
+        pass
+
+# HTTP server that answers each request in its own thread
+class StatusServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+# Build the status server and its index of the database at pathToDB
+# Takes the host and port to listen on as arguments.  Port 0 picks a free port
+# Returns the StatusServer object
+def statusServerMake(host, port):
+    StatusHandler.index = StatusIndex(pathToDB)
+    StatusHandler.index.refresh()
+    return StatusServer((host, port), StatusHandler)
+
+# Serve the device status as JSON over HTTP on serveHost:servePort until interrupted
+def statusServe():
+    if not os.path.isfile(pathToDB):
+        log("[!] No database found\n[!] Please run the program with the -p option to create and populate a database\n[!] Exiting\n\n")
+        cefMsg("DB Error",100)
+        print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
+        raise SystemExit
+    try:
+        server = statusServerMake(serveHost, servePort)
+    except (lite.Error, OSError) as e:
+        log("[!] Failed to start the status server\n[!] Error: "+ str(e) +"\n[!] Exiting\n\n")
+        cefMsg("Server Error",100)
+        print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
+        raise SystemExit
+    log("[+] Status server listening on http://"+ serveHost +":"+ str(server.server_address[1]) +"\n")
+    print("[+] Status server listening on http://"+ serveHost +":"+ str(server.server_address[1]))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        log("[-] Status server stopped\n\n")
+
 # Find the string that matches the date pattern.  If found, everything before the string becomes the device name.
 # Takes a string as an argument
 # Returns a list of the devName and the discovered date
@@ -372,23 +1126,1005 @@ def getDevNameFromPath(p):
     # If neither of those conditions is met, we don't want whatever this path is for
     return [p,False]
 
+# Directory entry read from a manifest.  Has the parts of os.DirEntry that the scanners use
+class ManifestEntry:
+    def __init__(self, parent, name, isDir):
+        self.name = name
+        self.path = parent +"/"+ name
+        self.isDir = isDir
+
+    def is_dir(self):
+        return self.isDir
+
+    def is_file(self):
+        return not self.isDir
+
+    def is_symlink(self):
+        return False
+
+# Read a manifest of device/date[/hour] paths into a tree of directories.  The last directory of each line is treated
+# as holding log files
+# Takes the path to the manifest file as an argument
+def manifestLoad(filePath):
+    global manifestPath, manifestTree
+    tree = {logDirPath: {}}
+    lines = 0
+    skipped = 0
+    log("[-] Reading the log directory structure from the manifest "+ filePath +"\n")
+    try:
+        if filePath.endswith(".gz"):
+            manifest = gzip.open(filePath, "rt")
+        else:
+            manifest = open(filePath)
+        with manifest:
+            for line in manifest:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                if line.startswith("/"):
+                    if not line.startswith(logDirPath +"/"):
+                        skipped += 1
+                        continue
+                    line = line[len(logDirPath) + 1:]
+                parent = logDirPath
+                for name in [sys.intern(n) for n in line.split("/") if n]:
+                    tree[parent][name] = True
+                    parent = parent +"/"+ name
+                    tree.setdefault(parent, {})
+                tree[parent]["manifest.log"] = False
+                lines += 1
+    except (OSError, EOFError, UnicodeDecodeError):
+        log("[!] Failed to read the manifest\n[!] Error: "+ str(sys.exc_info()[1]) +"\n[!] Exiting\n\n")
+        cefMsg("File Error",100)
+        print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
+        raise SystemExit
+    manifestPath = filePath
+    manifestTree = tree
+    log("[+] Read "+ str(lines) +" paths and "+ str(len(tree)) +" directories from the manifest, skipped "+ str(skipped) +" paths outside "+ logDirPath +"\n")
+
+# Paces the filesystem reads of a run.  A token bucket caps the reads per second, and the number of reads allowed to
+# run at once is raised by one per round of directory reads faster than ioLatencyTarget and cut by ioBackoff when one
+# is slower
+class IoGovernor:
+    def __init__(self, rate):
+        self.rate = rate
+        self.cond = threading.Condition()
+        self.tokens = float(ioBurst)
+        self.refilled = time.monotonic()
+        self.limit = 1.0
+        self.active = 0
+        self.sinceCut = 0
+        self.counters = {"reads": 0, "stats": 0, "waited seconds": 0.0, "latency seconds": 0.0, "latency max": 0.0,\
+        "latency ewma": 0.0, "raised": 0, "cut": 0, "prefetched": 0}
+
+    # Wait for a free slot and a token
+    def acquire(self):
+        with self.cond:
+            start = time.monotonic()
+            while True:
+                now = time.monotonic()
+                if self.rate:
+                    self.tokens = min(float(ioBurst), self.tokens + (now - self.refilled) * self.rate)
+                    self.refilled = now
+                if self.active < int(self.limit) and (not self.rate or self.tokens >= 1):
+                    break
+                if self.active < int(self.limit):
+                    self.cond.wait((1 - self.tokens) / self.rate)
+                else:
+                    self.cond.wait()
+            if self.rate:
+                self.tokens -= 1
+            self.active += 1
+            self.counters["waited seconds"] += time.monotonic() - start
+
+    # Free the slot and adjust the concurrency from the latency of a directory read
+    # Takes the number of seconds the read took, or None for reads that don't count, as an argument
+    def release(self, latency):
+        with self.cond:
+            self.active -= 1
+            if latency is not None:
+                self.counters["reads"] += 1
+                self.counters["latency seconds"] += latency
+                self.counters["latency max"] = max(self.counters["latency max"], latency)
+                self.counters["latency ewma"] = self.counters["latency ewma"] * 0.9 + latency * 0.1
+                self.sinceCut += 1
+                if latency > ioLatencyTarget:
+                    # Only cut once per round of reads at the current limit
+                    if self.sinceCut >= int(self.limit) and self.limit > 1:
+                        self.limit = max(1.0, self.limit * ioBackoff)
+                        self.sinceCut = 0
+                        self.counters["cut"] += 1
+                elif self.limit < ioMaxConcurrency:
+                    before = int(self.limit)
+                    self.limit = min(float(ioMaxConcurrency), self.limit + 1 / int(self.limit))
+                    self.counters["raised"] += int(self.limit) - before
+            else:
+                self.counters["stats"] += 1
+            self.cond.notify_all()
+
+    # Run a filesystem call under the governor
+    # Takes True if the call is a directory read whose latency drives the concurrency, the function, and its
+    # arguments as arguments
+    # Returns whatever the function returns
+    def call(self, isRead, func, *args):
+        self.acquire()
+        start = time.monotonic()
+        try:
+            return func(*args)
+        finally:
+            self.release(time.monotonic() - start if isRead else None)
+
+    # Copy the current limits and observed latencies into runMetrics
+    def export(self):
+        with self.cond:
+            metrics = dict(self.counters)
+        metrics["rate limit"] = self.rate
+        metrics["concurrency"] = int(self.limit)
+        metrics["max concurrency"] = ioMaxConcurrency
+        # Latencies are reported in milliseconds
+        metrics["latency avg"] = metrics["latency seconds"] / metrics["reads"] if metrics["reads"] else 0.0
+        for key in ("latency avg", "latency max", "latency ewma"):
+            metrics[key +" ms"] = metrics.pop(key) * 1000
+        runMetrics["io governor"] = metrics
+
+# Get the I/O governor for this process, starting it on first use
+# Returns the IoGovernor object
+def ioGovernorGet():
+    global ioGovernor
+    if ioGovernor is None:
+        ioGovernor = IoGovernor(ioRateLimit)
+    return ioGovernor
+
+# Read directories ahead of the audit with up to ioMaxConcurrency threads, so their listings are in the cache by the
+# time the audit gets to them.  The governor decides how many of the threads read at once
+# Takes a list of directory paths in the order the audit will read them as an argument
+# Returns a list of the threads and the threading.Event that stops them
+def ioPrefetchStart(paths):
+    stop = threading.Event()
+    queue = iter(paths)
+    queueLock = threading.Lock()
+
+    def prefetch():
+        while not stop.is_set():
+            with queueLock:
+                path = next(queue, None)
+            if path is None:
+                return
+            # The audit waits for a directory that is being read ahead instead of reading it again
+            if not dirClaim(path)[0]:
+                continue
+            entries = None
+            try:
+                entries = ioGovernorGet().call(True, lambda: list(os.scandir(path)))
+                with ioGovernorGet().cond:
+                    ioGovernorGet().counters["prefetched"] += 1
+            except OSError:
+                pass
+            finally:
+                dirRelease(path, entries)
+
+    threads = [threading.Thread(target=prefetch, daemon=True) for i in range(min(ioMaxConcurrency, len(paths)))]
+    if len(threads) > 1:
+        for t in threads:
+            t.start()
+    else:
+        threads = []
+    return [threads, stop]
+
+# Stop reading directories ahead of the audit
+# Takes the list returned by ioPrefetchStart() as an argument
+def ioPrefetchStop(prefetch):
+    prefetch[1].set()
+    for t in prefetch[0]:
+        t.join()
+
+# Start caching directory listings for the rest of the run, so each directory is read at most once
+def fsCacheStart():
+    global dirCache
+    if dirCache is not None:
+        return
+    dirCache = {}
+    runMetrics["dir cache"] = {"hits": 0, "misses": 0}
+
+# Claim a cached directory for reading, so that it is read once however many threads want it.  The check of the cache
+# and the claim are made under dirLock
+# Takes a string of the directory path as an argument
+# Returns a list of True and the threading.Event to pass to dirRelease() if this thread should read the directory,
+# else False and the Event of the thread reading it, or None if its listing is already cached
+def dirClaim(path):
+    with dirLock:
+        if path in dirCache:
+            return [False, None]
+        if path in dirPending:
+            return [False, dirPending[path]]
+        pending = threading.Event()
+        dirPending[path] = pending
+        return [True, pending]
+
+# Cache the listing of a claimed directory and wake the threads waiting for it.  Failed reads are not cached
+# Takes a string of the directory path and its listing, or None if the read failed, as arguments
+def dirRelease(path, entries):
+    with dirLock:
+        if entries is not None:
+            dirCache[path] = entries
+        pending = dirPending.pop(path)
+    pending.set()
+
+# Read a directory, from the manifest if one was given, else from the filesystem.  Once fsCacheStart() has been
+# called, listings are kept for the rest of the run.  Errors are not cached
+# Takes a string of the directory path as an argument
+# Returns a list of os.DirEntry or ManifestEntry objects
+def fsScanDir(path):
+    if dirCache is not None:
+        # Wait for a read ahead of the same directory, and read it here if that read failed
+        claimed, pending = dirClaim(path)
+        while pending and not claimed:
+            pending.wait()
+            claimed, pending = dirClaim(path)
+        if not claimed:
+            runMetrics["dir cache"]["hits"] += 1
+            return dirCache[path]
+        runMetrics["dir cache"]["misses"] += 1
+    entries = None
+    try:
+        if manifestTree is not None:
+            entries = [ManifestEntry(path, name, isDir) for name, isDir in manifestTree.get(path, {}).items()]
+        else:
+            entries = ioGovernorGet().call(True, lambda: list(os.scandir(path)))
+    finally:
+        if dirCache is not None:
+            dirRelease(path, entries)
+    return entries
+
+# Takes a string of the directory path as an argument
+# Returns a list of the names in the directory
+def fsListDir(path):
+    return [sys.intern(e.name) for e in fsScanDir(path)]
+
+# Takes a string of a path as an argument
+# Returns True if the path is a directory, else False
+def fsIsDir(path):
+    if manifestTree is not None:
+        return path in manifestTree
+    # Use the listing of the parent directory if it has already been read
+    parent, name = path.rsplit("/", 1)
+    if dirCache is not None and parent in dirCache:
+        runMetrics["dir cache"]["hits"] += 1
+        return bool([e for e in dirCache[parent] if e.name == name and e.is_dir()])
+    return ioGovernorGet().call(False, os.path.isdir, path)
+
+# Walk a directory tree top down like os.walk, using the manifest if one was given.  Unreadable directories are skipped
+# Takes a string of the directory path as an argument
+# Yields lists of the directory path, the subdirectory names, and the file names
+def fsWalk(path):
+    try:
+        entries = fsScanDir(path)
+    except OSError:
+        return
+    dirs = [e.name for e in entries if e.is_dir()]
+    files = [e.name for e in entries if not e.is_dir()]
+    walkInto = [e.name for e in entries if e.is_dir() and not e.is_symlink()]
+    yield [path, dirs, files]
+    for d in dirs:
+        if d in walkInto:
+            yield from fsWalk(path +"/"+ d)
+
+# Compile the layout templates into lists of scan levels.  Only done once per run
+# Returns a list of lists containing the template string and its list of (kind, value) levels
+def layoutCompile():
+    global layoutsCompiled
+    if layoutsCompiled is not None:
+        return layoutsCompiled
+    compiled = []
+    for template in layoutTemplates:
+        parts = [part for part in template.split("/") if part]
+        levels = []
+        for part in parts[1:]:
+            if part == "{device}":
+                levels.append(("device", None))
+            elif part == "{date}":
+                levels.append(("date", None))
+                break
+            elif part.startswith("{") and part.endswith("}"):
+                levels.append(("any", part[1:-1]))
+            else:
+                levels.append(("literal", part))
+        kinds = [l[0] for l in levels]
+        if not parts or parts[0] != "{root}" or "device" not in kinds or kinds[-1] != "date" or kinds.index("device") > len(kinds) - 2:
+            log("[!] Invalid layout template: "+ template +"\n[!] Templates must start with {root} and contain {device} followed by {date}\n[!] Exiting\n\n")
+            cefMsg("Config Error",100)
+            print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
+            raise SystemExit
+        compiled.append([template, levels])
+    layoutsCompiled = compiled
+    log("[+] Compiled "+ str(len(compiled)) +" layout templates\n")
+    return layoutsCompiled
+
+# Walk down a directory following the levels of a compiled layout template.  Only lists the levels the template needs
+# and stops at the date level.  Directories named like dates are never treated as site or device directories
+# Takes the template levels, the path matching levels[depth], the device path found so far, the dictionary of found
+# devices and the cost counters as arguments
+def layoutScan(levels, path, depth, devPath, found, cost, visited):
+    kind, value = levels[depth]
+    if kind == "device":
+        devPath = path
+    nextKind, nextValue = levels[depth + 1]
+
+    # Plain text levels only need a single check for the expected directory
+    if nextKind == "literal":
+        if fsIsDir(path +"/"+ nextValue):
+            layoutScan(levels, path +"/"+ nextValue, depth + 1, devPath, found, cost, visited)
+        return
+
+    # Get the subdirectories of this level
+    try:
+        entries = fsScanDir(path)
+    except OSError:
+        return
+    names = [e.name for e in entries if e.is_dir()]
+    cost["listed"] += 1
+    visited.append(path)
+
+    # At the date level, record the device and the dates found under it or in its log archives
+    if nextKind == "date":
+        dates = [getDevNameFromPath("/"+ n)[1] for n in names if re.match(ptrnDateRecalcFreq, n)]
+        dates = [d for d in dates if d]
+        archives = archiveDirDays(path, [e.name for e in entries if not e.is_dir()])
+        dates.extend([datetime.date.fromordinal(day) for day in sorted(archives)])
+        if dates or 'today' in names or 'yesterday' in names:
+            found.setdefault(devPath, [])
+            found[devPath].extend(dates)
+        return
+    for n in names:
+        if not re.match(ptrnDateRecalcFreq, n):
+            layoutScan(levels, path +"/"+ n, depth + 1, devPath, found, cost, visited)
+
+# Discover the devices under a top level directory of logDirPath using every layout template
+# Takes a string of the directory path and a list that the listed directories are appended to as arguments
+# Returns a dictionary of device paths and lists of datetime date objects
+def layoutDiscover(path, visited):
+    found = {}
+    for template, levels in layoutCompile():
+        cost = runMetrics.setdefault("layout "+ template, {"scans": 0, "listed": 0, "devices": 0, "seconds": 0.0})
+        start = time.time()
+        before = len(found)
+        # The top level directory must itself match the first level of the template
+        if levels[0][0] != "literal" or levels[0][1] == os.path.basename(path):
+            layoutScan(levels, path, 0, None, found, cost, visited)
+        cost["scans"] += 1
+        cost["devices"] += len(found) - before
+        cost["seconds"] += time.time() - start
+    return found
+
+# Load the discovery cache of directories that were searched without finding any devices
+# Takes a sqlite3 database cursor as an argument
+# Returns a dictionary of paths and lists of a dictionary of subdirectory mtimes and the directory listing
+def discoveryLoad(dbc):
+    cache = {}
+    try:
+        dbc.execute("SELECT path, mtimes, listing FROM discovery")
+        for r in dbc.fetchall():
+            cache[r[0]] = [json.loads(r[1]) if r[1] else {}, json.loads(r[2]) if r[2] else []]
+    except (lite.Error, ValueError) as e:
+        log("[!] Failed to load the discovery cache\n[!] Error: "+ str(e) +"\n[!] Exiting\n\n")
+        cefMsg("Query Error",100)
+        print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
+        raise SystemExit
+    log("[+] Loaded "+ str(len(cache)) +" entries from the discovery cache\n")
+    return cache
+
+# Check whether any of the directories recorded for a cached path have changed
+# Takes a dictionary of directory paths and mtimes as an argument
+# Returns True if every directory still exists with the same mtime, else False
+def discoveryUnchanged(mtimes):
+    if not mtimes:
+        return False
+    for path, mtime in mtimes.items():
+        runMetrics["discovery cache"]["stats"] += 1
+        try:
+            if ioGovernorGet().call(False, os.stat, path).st_mtime != mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+# Get the current mtimes of a list of directories
+# Takes a list of directory paths as an argument
+# Returns a dictionary of paths and mtimes
+def discoverySnapshot(paths):
+    mtimes = {}
+    for path in set(paths):
+        try:
+            mtimes[path] = ioGovernorGet().call(False, os.stat, path).st_mtime
+        except OSError:
+            continue
+    return mtimes
+
+# Check whether a file name looks like a log archive
+# Takes a string of the file name as an argument
+# Returns True if the name ends with one of the archiveExtensions, else False
+def archiveName(name):
+    return archiveIndexing and name.endswith(archiveExtensions) and not name.startswith(".")
+
+# Get the day of a date, as YYYY-MM-DD or YYYYMMDD, found anywhere in a file name
+# Takes a string of the file name as an argument
+# Returns the date ordinal, or None if there is no valid date in the name
+def archiveNameDay(name):
+    for res in re.finditer(ptrnDateArchive, name):
+        try:
+            return datetime.date(int(res.group(1)), int(res.group(2)), int(res.group(3))).toordinal()
+        except ValueError:
+            continue
+    return None
+
+# Load the days of the archives indexed by earlier runs
+# Takes a sqlite3 database cursor as an argument
+def archiveLoad(dbc):
+    global archiveIndex
+    archiveIndex = {}
+    try:
+        dbc.execute("SELECT path, size, mtime, days FROM archive_index")
+        for r in dbc.fetchall():
+            archiveIndex[r[0]] = [r[1], r[2], [int(day) for day in r[3].split(",") if day]]
+    except (lite.Error, ValueError) as e:
+        log("[!] Failed to load the archive index\n[!] Error: "+ str(e) +"\n[!] Exiting\n\n")
+        cefMsg("Query Error",100)
+        print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
+        raise SystemExit
+    log("[+] Loaded "+ str(len(archiveIndex)) +" entries from the archive index\n")
+
+# Save the archives indexed during this run.  Does not commit
+# Takes a sqlite3 database cursor as an argument
+def archiveSave(dbc):
+    if not archiveUpdates:
+        return
+    log("[-] Saving "+ str(len(archiveUpdates)) +" entries in the archive index\n")
+    try:
+        dbc.executemany("INSERT OR REPLACE INTO archive_index (path, size, mtime, days) VALUES (?, ?, ?, ?)",\
+        [(path, i[0], i[1], ",".join([str(day) for day in i[2]])) for path, i in archiveUpdates.items()])
+    except lite.Error as e:
+        log("[!] Failed to save the archive index\n[!] Error: "+ str(e) +"\n[!] Exiting\n\n")
+        cefMsg("Query Error",100)
+        print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
+        raise SystemExit
+    archiveUpdates.clear()
+
+# Get the days covered by a log archive.  Tar archives are read one member header at a time and the member contents
+# are never extracted.  An archive that can't be read only counts for the date in its own name
+# Takes a string of the archive path as an argument
+# Returns a list of date ordinals
+def archiveDays(path):
+    counters = runMetrics.setdefault("archives", {"cached": 0, "indexed": 0, "members": 0, "errors": 0})
+    try:
+        st = ioGovernorGet().call(False, os.stat, path)
+    except OSError:
+        return []
+    cached = archiveIndex.get(path)
+    if cached and cached[0] == st.st_size and cached[1] == st.st_mtime:
+        counters["cached"] += 1
+        return cached[2]
+
+    days = set()
+    nameDay = archiveNameDay(os.path.basename(path))
+    if nameDay:
+        days.add(nameDay)
+    name = os.path.basename(path)
+    if ".tar" in name or name.endswith(".tgz"):
+        try:
+            with tarfile.open(path, "r:*") as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    counters["members"] += 1
+                    memberDay = archiveNameDay(os.path.basename(member.name))
+                    if not memberDay:
+                        memberDay = datetime.date.fromtimestamp(member.mtime).toordinal()
+                    days.add(memberDay)
+        except (tarfile.TarError, OSError, EOFError, ValueError, OverflowError) as e:
+            log("[!] Failed to read the archive "+ path +"\n[!] Error: "+ str(e) +"\n")
+            counters["errors"] += 1
+    counters["indexed"] += 1
+    archiveIndex[path] = [st.st_size, st.st_mtime, sorted(days)]
+    archiveUpdates[path] = archiveIndex[path]
+    return archiveIndex[path][2]
+
+# Get the days covered by the log archives in a directory
+# Takes a string of the directory path and a list of the file names in it as arguments
+# Returns a set of date ordinals
+def archiveDirDays(path, names):
+    days = set()
+    if manifestTree is not None:
+        return days
+    for name in names:
+        if archiveName(name):
+            days.update(archiveDays(path +"/"+ name))
+    return days
+
+# Count the files and bytes in a device's directory for today, including one level of hour subdirectories
+# Takes an os.DirEntry of today's directory as an argument
+# Returns a list of the number of files and the total number of bytes
+def volumeScan(entry):
+    files = 0
+    size = 0
+    dirs = [entry]
+    depth = 0
+    while dirs and depth < 2:
+        subDirs = []
+        for d in dirs:
+            try:
+                for e in fsScanDir(d.path):
+                    if e.is_file():
+                        files += 1
+                        size += ioGovernorGet().call(False, e.stat).st_size
+                    elif e.is_dir():
+                        subDirs.append(e)
+            except OSError:
+                continue
+        dirs = subDirs
+        depth += 1
+    return [files, size]
+
+# Load the rolling windows of daily log volume
+# Takes a sqlite3 database cursor as an argument
+# Returns a dictionary of dev_ids and lists of [day ordinal, bytes, files, hours] lists
+def volumeLoad(dbc):
+    windows = {}
+    try:
+        dbc.execute("SELECT dev_id, window FROM volume")
+        for r in dbc.fetchall():
+            windows[r[0]] = [[int(x) for x in day.split(":")] for day in r[1].split(",") if day]
+    except (lite.Error, ValueError) as e:
+        log("[!] Failed to load the log volume history\n[!] Error: "+ str(e) +"\n[!] Exiting\n\n")
+        cefMsg("Query Error",100)
+        print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
+        raise SystemExit
+    return windows
+
+# Add today's volume to a device's rolling window and compare it with the median of the previous days
+# Each sample keeps the number of hours of the day it covers, so days sampled at different times are compared as bytes
+# per hour.  Samples from before the hour was stored are taken as whole days.  A sample taken during the first hour of
+# the day counts as one hour, and is not compared
+# Takes the window list, the number of files, and the number of bytes as arguments
+# Returns True if the volume has dropped below volumeDropFraction of the expected volume, else False
+def volumeCheck(window, files, size):
+    today = dateNow().toordinal()
+    window[:] = [day for day in window if day[0] != today and day[0] > today - volumeWindow]
+    prevRates = [day[1] / (max(day[3], 1) if len(day) > 3 else 24) for day in window]
+    window.append([today, size, files, max(hourNow, 1)])
+    if len(prevRates) < volumeMinSamples or hourNow == 0:
+        return False
+    return size / hourNow < statistics.median(prevRates) * volumeDropFraction
+
+# Clear the state kept for a single audit before the next one in a long running process
+def runReset():
+    global dirCache, hourNow, hourPrev, reportFileName
+    dirCache = None
+    dirPending.clear()
+    runMetrics.clear()
+    hourNow = timeNow().hour
+    hourPrev = 23 if hourNow == 0 else hourNow - 1
+    reportFileName = "logTrackerReport_"+ str(datetime.datetime.now()).split(".")[0].replace(" ","_").replace(":",".")
+
+# Write the counters collected in runMetrics into the operations log
+def metricsLog():
+    if ioGovernor:
+        ioGovernor.export()
+    for name in sorted(runMetrics):
+        counters = runMetrics[name]
+        log("[+] Metrics for "+ name +": "+ ", ".join([k +"="+ (str(round(v, 3)) if isinstance(v, float) else str(v)) for k, v in sorted(counters.items())]) +"\n")
+
+# Start profiling the phases of this run.  "full" runs cProfile and tracemalloc in each phase, "sample" records the
+# main thread's stack every profileSampleInterval seconds from a background thread
+# Takes a string of the profile mode as an argument
+def profileStart(mode):
+    global profileMode, profileRun, profileSampler
+    profileMode = mode
+    profileRun = datetime.datetime.now().strftime("%Y%m%d_%H%M%S") +"_"+ str(os.getpid())
+    if mode == "full":
+        tracemalloc.start(profileFrames)
+    else:
+        stop = threading.Event()
+        profileSampler = [threading.Thread(target=profileSample, args=(threading.main_thread().ident, stop), daemon=True), stop]
+        profileSampler[0].start()
+    atexit.register(profileStop)
+    log("[+] Profiling "+ ("every phase" if mode == "full" else "by sampling") +", writing the results to "+ pathToOpLog +"/logTrackerProfile_"+ profileRun +"_*\n")
+
+# End any phases still running and stop profiling.  Runs at exit so that a run stopped early still writes its profiles
+def profileStop():
+    global profileMode, profileSampler
+    while phaseStack:
+        phaseEnd()
+    phaseHeldEnd()
+    if profileSampler:
+        profileSampler[1].set()
+        profileSampler[0].join()
+        profileSampler = None
+    if profileMode == "full" and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    profileMode = None
+
+# Record the stack of the main thread into the current phase until stopped
+# Takes the thread id of the main thread and a threading.Event that stops the sampling as arguments
+def profileSample(threadId, stop):
+    while not stop.wait(profileSampleInterval):
+        frame = sys._current_frames().get(threadId)
+        try:
+            samples = phaseStack[-1]["samples"]
+        except IndexError:
+            continue
+        stack = []
+        while frame:
+            stack.append(os.path.basename(frame.f_code.co_filename) +":"+ frame.f_code.co_name)
+            frame = frame.f_back
+        key = ";".join(reversed(stack))
+        samples[key] = samples.get(key, 0) + 1
+
+# Start a named phase of the run.  The time spent in it is added to runMetrics, and if profiling, it is profiled on its
+# own.  A phase started inside another pauses the outer phase's profiler until it ends.  A repeated phase is one that
+# runs many times interleaved with others, such as the steps of populating each top level directory.  Its runs share
+# one profile, written by phaseHeldEnd()
+# Takes a string of the phase name and optionally True if the phase is repeated as arguments
+def phaseBegin(name, repeat=False):
+    phase = phaseHeld.pop(name, None)
+    if phase is None:
+        phase = {"name": name, "repeat": repeat, "seconds": 0.0, "profiler": None, "snapshot": None, "samples": {}}
+        if profileMode == "full":
+            phase["snapshot"] = tracemalloc.take_snapshot()
+            phase["profiler"] = cProfile.Profile()
+    phase["start"] = time.time()
+    if phase["profiler"]:
+        if phaseStack and phaseStack[-1]["profiler"]:
+            phaseStack[-1]["profiler"].disable()
+        phase["profiler"].enable()
+    phaseStack.append(phase)
+
+# End the most recent phase and write its profile into pathToOpLog.  A repeated phase is held until phaseHeldEnd()
+def phaseEnd():
+    phase = phaseStack.pop()
+    seconds = time.time() - phase["start"]
+    phase["seconds"] += seconds
+    if phase["profiler"]:
+        phase["profiler"].disable()
+    counters = runMetrics.setdefault("phase "+ phase["name"], {"runs": 0, "seconds": 0.0})
+    counters["runs"] += 1
+    counters["seconds"] += seconds
+    if phase["repeat"]:
+        phaseHeld[phase["name"]] = phase
+    elif profileMode:
+        phaseWrite(phase)
+    if phaseStack and phaseStack[-1]["profiler"]:
+        phaseStack[-1]["profiler"].enable()
+
+# Write the profiles of the repeated phases, covering all of their runs so far
+def phaseHeldEnd():
+    for name in sorted(phaseHeld):
+        if profileMode:
+            phaseWrite(phaseHeld[name])
+    phaseHeld.clear()
+
+# Write the profile of a phase into pathToOpLog.  For a repeated phase, the allocations are those made since its first
+# run, including the ones made by the phases that ran in between
+# Takes the phase dictionary as an argument
+def phaseWrite(phase):
+    global profileCount
+    profileCount += 1
+    filePrefix = pathToOpLog +"/logTrackerProfile_"+ profileRun +"_"+ str(profileCount).zfill(2) +"_"+ phase["name"].replace(" ", "_")
+    try:
+        if phase["profiler"]:
+            phase["profiler"].dump_stats(filePrefix +".pstats")
+            # The allocation sites that grew the most during the phase
+            ignore = [tracemalloc.Filter(False, cProfile.__file__), tracemalloc.Filter(False, tracemalloc.__file__)]
+            stats = tracemalloc.take_snapshot().filter_traces(ignore).compare_to(phase["snapshot"].filter_traces(ignore), "lineno")
+            with open(filePrefix +".alloc.txt", "w") as allocFile:
+                allocFile.write("Top "+ str(profileTopAllocations) +" allocation sites for phase "+ phase["name"] +"\n")
+                for stat in stats[:profileTopAllocations]:
+                    allocFile.write(str(stat) +"\n")
+        else:
+            # Collapsed stacks, one per line with the number of samples, as read by flame graph tools
+            with open(filePrefix +".folded", "w") as sampleFile:
+                for stack, count in sorted(phase["samples"].items()):
+                    sampleFile.write(stack +" "+ str(count) +"\n")
+    except OSError as e:
+        log("[!] Failed to write the profile of phase "+ phase["name"] +"\n[!] Error: "+ str(e) +"\n")
+    log("[+] Phase "+ phase["name"] +" took "+ str(round(phase["seconds"], 3)) +" seconds\n")
+
+# Copy one sqlite3 database into another, with the online backup API if it is available
+# Takes the source and destination sqlite3 connections as arguments
+def dbCopy(src, dst):
+    if hasattr(src, "backup"):
+        src.backup(dst)
+    else:
+        dst.executescript("\n".join(src.iterdump()))
+        dst.commit()
+
+# Check that the sqlite3 trace callback shows the values bound to a statement, which the journal needs
+# Returns True if it does, else False
+def dbJournalSupported():
+    seen = []
+    probe = lite.connect(":memory:")
+    probe.set_trace_callback(seen.append)
+    probe.execute("SELECT ?", ("journal-probe",))
+    probe.close()
+    return bool([st for st in seen if "journal-probe" in st])
+
+# Apply the committed changes in a journal left by a run that did not write its in-memory database back.  Each
+# transaction in the journal is numbered, and the number of the last one applied is kept in the journal_state table,
+# so a journal that outlived the write back of its changes is not applied twice.  The caller removes the journal once
+# the changes are safely on disk
+# Takes a sqlite3 connection and the path to the database file as arguments
+# Returns True if there was a journal, else False
+def dbJournalReplay(dbconn, diskPath):
+    journalPath = diskPath +".journal"
+    if not os.path.isfile(journalPath):
+        return False
+    replayed = 0
+    skipped = 0
+    try:
+        dbinit.upgradeDB(dbconn.cursor())
+        row = dbconn.execute("SELECT seq FROM journal_state WHERE id = 1").fetchone()
+        applied = row[0] if row else 0
+        with open(journalPath) as journal:
+            statements = []
+            for line in journal:
+                line = line.strip()
+                if line.split(" ")[0] == "COMMIT":
+                    seq = int(line.split(" ")[1]) if " " in line else None
+                    if seq is None or seq > applied:
+                        for st in statements:
+                            dbconn.execute(st)
+                        if seq is not None:
+                            dbconn.execute("INSERT OR REPLACE INTO journal_state (id, seq) VALUES (1, ?)", (seq,))
+                            applied = seq
+                        replayed += 1
+                    else:
+                        skipped += 1
+                    statements = []
+                elif line:
+                    statements.append(json.loads(line))
+        dbconn.commit()
+    except (OSError, ValueError, lite.Error) as e:
+        log("[!] Failed to replay the database journal "+ journalPath +"\n[!] Error: "+ str(e) +"\n[!] Exiting\n\n")
+        cefMsg("DB Error",100)
+        print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
+        raise SystemExit
+    log("[+] Replayed "+ str(replayed) +" transactions from the database journal, "+ str(skipped) +" were already applied\n")
+    return True
+
+# sqlite3 connection to an in-memory copy of the database file.  See dbInMemory.  The copy is kept for the rest of the
+# process, so closing the connection only writes it back and the next dbMakeConnection() gets it again, unless another
+# program has changed the file since
+class MemoryConnection(lite.Connection):
+    # Takes the path to the database file as an argument
+    def setup(self, diskPath):
+        self.diskPath = diskPath
+        self.stamp = self.diskStamp()
+        self.lastPersist = time.time()
+        self.persistedChanges = self.total_changes
+        self.pending = []
+        self.seq = None
+        self.exiting = False
+        self.isClosed = False
+        atexit.register(self.persistAtExit)
+
+    # Get the inode, size and modification time of the database file, which change when another program writes it
+    # Returns a tuple, or None if the file is missing
+    def diskStamp(self):
+        try:
+            st = os.stat(self.diskPath)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    # Start journaling the committed changes, if dbJournal is set
+    def journalStart(self):
+        if not dbJournal or dbScratch:
+            return
+        if dbJournalSupported():
+            self.set_trace_callback(self.trace)
+        else:
+            log("[!] This version of sqlite3 does not show bound values to the trace callback, journal disabled\n")
+
+    # Keep the statements that change the database until they are committed
+    def trace(self, statement):
+        words = statement.split(None, 1)
+        if words and words[0].upper() in ("INSERT", "UPDATE", "DELETE", "REPLACE", "CREATE", "DROP", "ALTER"):
+            self.pending.append(statement)
+
+    def commit(self):
+        # Number the transaction in the database as well as in the journal
+        if self.pending:
+            if self.seq is None:
+                row = self.execute("SELECT seq FROM journal_state WHERE id = 1").fetchone()
+                self.seq = row[0] if row else 0
+            self.seq += 1
+            self.set_trace_callback(None)
+            self.execute("INSERT OR REPLACE INTO journal_state (id, seq) VALUES (1, ?)", (self.seq,))
+            self.set_trace_callback(self.trace)
+        super().commit()
+        if self.pending:
+            try:
+                with open(self.diskPath +".journal", "a") as journal:
+                    for st in self.pending:
+                        journal.write(json.dumps(st) +"\n")
+                    journal.write("COMMIT "+ str(self.seq) +"\n")
+                    journal.flush()
+                    os.fsync(journal.fileno())
+            except OSError as e:
+                # Without the journal the only way to keep the change is to write the database back now
+                log("[!] Failed to write the database journal, writing the database back instead\n[!] Error: "+ str(e) +"\n")
+                self.pending = []
+                self.persist()
+            self.pending = []
+        if time.time() - self.lastPersist >= dbPersistSeconds:
+            self.persist()
+
+    def rollback(self):
+        super().rollback()
+        self.pending = []
+
+    # Write the in-memory database to a temporary file and rename it over the database file.  The journal is removed
+    # after the rename, and if the program dies in between, the transaction numbers stop it from being applied again
+    def persist(self):
+        if dbScratch or self.total_changes == self.persistedChanges:
+            self.lastPersist = time.time()
+            return
+        tmpPath = self.diskPath +".tmp"
+        try:
+            if os.path.isfile(tmpPath):
+                os.remove(tmpPath)
+            disk = lite.connect(tmpPath)
+            dbCopy(self, disk)
+            disk.close()
+            os.replace(tmpPath, self.diskPath)
+            if os.path.isfile(self.diskPath +".journal"):
+                os.remove(self.diskPath +".journal")
+        except (OSError, lite.Error) as e:
+            log("[!] Failed to write the in-memory database to "+ self.diskPath +"\n[!] Error: "+ str(e) +"\n")
+            cefMsg("DB Error",100)
+            raise SystemExit
+        self.stamp = self.diskStamp()
+        self.lastPersist = time.time()
+        self.persistedChanges = self.total_changes
+        log("[+] In-memory database written to "+ self.diskPath +"\n")
+
+    # Write the database back and keep it for the next connection.  The connection is only really closed at exit.  With
+    # --every the file is then up to date whenever the run lock is free between audits
+    def close(self):
+        if self.isClosed:
+            return
+        if self.in_transaction:
+            self.rollback()
+        self.persist()
+        if not self.exiting:
+            return
+        self.isClosed = True
+        super().close()
+
+    # Close the connection without writing it back, once the file has been changed by another program
+    def discard(self):
+        self.isClosed = True
+        super().close()
+
+    # Write back whatever was committed and close the connection when the program exits
+    def persistAtExit(self):
+        self.exiting = True
+        self.close()
+
+# Bring an older database up to date: add new tables and columns, and store the device names under logDirPath relative
+# to it.  The name migration only runs once, tracked with the database's user_version.  Sets rootId and rootPaths
+# Quits if devices are stored under a root other than logDirPath, since their names would resolve to the wrong place
+# Takes a sqlite3 database connection as an argument
+def dbUpgrade(dbconn):
+    global rootId, rootPaths
+    dbc = dbconn.cursor()
+    dbinit.upgradeDB(dbc)
+    try:
+        dbc.execute("SELECT r.root_id, r.root_path, count(d.{did}) FROM roots r JOIN {tn} d ON d.{rid} = r.root_id WHERE r.root_path != ? GROUP BY r.root_id"\
+        .format(tn=tbl_devs, did=col_devid, rid=col_rootid), (logDirPath,))
+        stray = dbc.fetchall()
+    except lite.Error as e:
+        log("[!] Failed to read the log roots\n[!] Error: "+ str(e) +"\n[!] Exiting\n\n")
+        cefMsg("DB Error",100)
+        print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
+        raise SystemExit
+    if stray:
+        for r in stray:
+            log("[!] "+ str(r[2]) +" devices are stored under "+ r[1] +" (root_id "+ str(r[0]) +"), not under logDirPath "+ logDirPath +"\n")
+        log("[!] If the log tree has moved, update its root_path in the roots table to the new location\n[!] Exiting\n\n")
+        cefMsg("DB Error",100)
+        print("\n[!] The database was built for a different log directory\n[!] Please check the log for details\n[!] Quitting\n\n")
+        raise SystemExit
+    try:
+        dbc.execute("INSERT OR IGNORE INTO roots (root_path) VALUES (?)", (logDirPath,))
+        dbc.execute("SELECT root_id, root_path FROM roots")
+        rootPaths = dict(dbc.fetchall())
+        rootId = [i for i in rootPaths if rootPaths[i] == logDirPath][0]
+        dbc.execute("PRAGMA user_version")
+        if dbc.fetchone()[0] < 1:
+            prefix = logDirPath +"/"
+            dbc.execute("UPDATE {tn} SET {dn} = substr({dn}, ?), {rid} = ? WHERE {rid} IS NULL AND substr({dn}, 1, ?) = ?"\
+            .format(tn=tbl_devs, dn=col_dname, rid=col_rootid), (len(prefix) + 1, rootId, len(prefix), prefix))
+            migrated = dbc.rowcount
+            dbc.execute("UPDATE events SET dev_name = substr(dev_name, ?) WHERE substr(dev_name, 1, ?) = ?", (len(prefix) + 1, len(prefix), prefix))
+            dbc.execute("PRAGMA user_version = 1")
+            dbconn.commit()
+            if migrated > 0:
+                log("[+] Stored "+ str(migrated) +" device names relative to "+ logDirPath +"\n")
+                dbconn.execute("VACUUM")
+
+        # Older databases stored every routine event, count them per day instead
+        dbc.execute("PRAGMA user_version")
+        if dbc.fetchone()[0] < 2:
+            codes = ",".join([str(c) for c in eventSummaryCodes])
+            dbc.execute("INSERT INTO event_counts (code, day, count) SELECT code, day, COUNT(*) FROM events WHERE code IN ("+ codes +") GROUP BY code, day")
+            dbc.execute("DELETE FROM events WHERE code IN ("+ codes +")")
+            summarized = dbc.rowcount
+            dbc.execute("PRAGMA user_version = 2")
+            dbconn.commit()
+            if summarized > 0:
+                log("[+] Replaced "+ str(summarized) +" routine events with daily counts\n")
+                dbconn.execute("VACUUM")
+        dbconn.commit()
+    except lite.Error as e:
+        log("[!] Failed to upgrade the database\n[!] Error: "+ str(e) +"\n[!] Exiting\n\n")
+        cefMsg("DB Error",100)
+        print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
+        raise SystemExit
+
 # Confirm databse location, establish and return database connection
 # Takes string of directory path as an argument
 # Returns a sqlite3 database connection object
 def dbMakeConnection(pathToDB):
+    global dbMemory
     # Establish database connection
     log("[-] Looking for database\n")
+    # The in-memory copy is loaded once and used by every connection of the process.  It is loaded again if another
+    # program, e.g. a -c run between two audits of --every, has changed the file since it was loaded or written back
+    if dbInMemory and dbMemory is not None:
+        if dbScratch or dbMemory.stamp == dbMemory.diskStamp():
+            log("[+] Using the database already loaded into memory\n")
+            return dbMemory
+        log("[-] The database file has changed since it was loaded, loading it into memory again\n")
+        dbMemory.discard()
+        dbMemory = None
     if os.path.isfile(pathToDB):
         log("[-] Database found, creating database connection\n")
-        # Create the database connection
+        # Create the database connection, loading the database into memory if dbInMemory is set
         try:
-            dbconn = lite.connect(pathToDB)
-        except lite.Error as e:
+            if dbInMemory:
+                dbconn = lite.connect(":memory:", factory=MemoryConnection)
+                dbDisk = lite.connect(pathToDB)
+                dbCopy(dbDisk, dbconn)
+                dbDisk.close()
+                dbconn.setup(pathToDB)
+                log("[+] Database loaded into memory\n")
+            else:
+                dbconn = lite.connect(pathToDB)
+
+            # Replayed changes are only safe once they are on disk, so the journal is kept until then
+            if dbJournalReplay(dbconn, pathToDB):
+                if dbInMemory:
+                    dbconn.persist()
+                elif not dbScratch:
+                    os.remove(pathToDB +".journal")
+        except (lite.Error, OSError) as e:
             log("[!] Failed to connect to the database\n[!] Error: " + str(e) + "\n[!] Exiting\n\n")
             cefMsg("DB Error",100)
             print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
             raise SystemExit
         log("[+] Database connection created\n")
+        dbUpgrade(dbconn)
+        if dbInMemory:
+            dbconn.journalStart()
+            dbMemory = dbconn
+    # A scratch run without a database works on an empty one that is never written to disk
+    elif dbScratch:
+        log("[-] No database found, using an empty scratch database\n")
+        dbconn = lite.connect(":memory:", factory=MemoryConnection)
+        dbconn.setup(pathToDB)
+        dbinit.createDB(dbconn.cursor())
+        dbUpgrade(dbconn)
+        dbMemory = dbconn
     # If the database is not found, create a new one
     else:
         log("[!] No database found\n[!] Please run the program with the -p option to create and populate a database\n[!] Exiting\n\n")
@@ -415,11 +2151,8 @@ def dbMakeCursor(dbconn):
 # Populate a new database.  This function is highly dependant on your local directory structure
 # Takes a sqlite3 connection, cursor, and string of a directory path as arguments
 def dbPopulate(c, conn, path):
-    dateToday = str(datetime.date.today())
-    twoMonths = datetime.timedelta(days=daysToInactive)
+    phaseBegin("populate")
     dbEntries = []
-    dictDevDate = {}
-    delFromDict = []
     
     # Make sure the database is empty before continuing
     try:
@@ -437,116 +2170,206 @@ def dbPopulate(c, conn, path):
         print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
         raise SystemExit
 
-    # Walk through the directory tree recursively 
+    # Walk through the directory tree one top level directory at a time.  The devices under a top level directory are
+    # added to the database as soon as it has been read, so memory use does not grow with the size of the tree
     log("[-] Walking the directory tree looking for log files and devices\n")
-    for p in glob.glob(path+'/**/*', recursive=True):
-
-        # If the path ends in a file
-        if os.path.isfile(p):
-
-            # Find a string that matches the date pattern.  If found, everything before the date
-            # string becomes the device name.  Returns list of name and the date
-            #print(p)
-            devName = getDevNameFromPath(p)
-            if not devName[1]:
-                continue
-            else:  
-                if devName[0] in dictDevDate:
-                    dictDevDate[devName[0]].append(devName[1])
-                else:
-                    dictDevDate.setdefault(devName[0], [])
-                    dictDevDate[devName[0]].append(devName[1])
-
-    # Purge devices on the skip list
-    for dev, date in dictDevDate.items():
-        for name in devicesDontAudit:
-            if name in dev:
-                delFromDict.append(dev)
-    for dev in delFromDict:
-        if dev in dictDevDate:
-            del dictDevDate[dev]
-    
-    # Step through the dictionary, determine the date of the most recent collected log, determine if the device 
-    # is actively logging, determine a frequencey if there are relatively recent logs, add the appropriate
-    # values string for the insert query
-    log("[-] Calculating logging frequency and activity status for "+ str(len(dictDevDate)) +" devices\n")
+    tops = [e.path for e in fsScanDir(path) if not e.name.startswith(".")]
+    log("[+] Found "+ str(len(tops)) +" top level directories\n")
+    sumDevs = 0
+    sumDirs = 0
     sumInactiveDevs = 0
-    skipAnomDevices = []
-    for dev, dates in dictDevDate.items():
-        freq = 1
-        # Test to make sure the list of dates was populated
-        if not dates:
-            skipAnomDevices.append(dev)
-            continue
-
-        # If the device hasn't logged in over 2 months, insert the device as inactive
-        lastLogDate = max(dates)
-        firstLogDate = min(dates)
-        if datetime.date.today() - lastLogDate > twoMonths:
-            entry =  (dev, str(firstLogDate), str(lastLogDate), '1','0','1', dateToday,'1',dateToday)
-            dbEntries.append(entry)
-            sumInactiveDevs += 1
-
-        # If there is only one log entry, add it and set the frequency to half the number of days between now and the last log entry
-        elif len(set(dates)) == 1:
-            delta = datetime.date.today() - lastLogDate
-            freq = ceil(delta.days/2)
-            if freq == 0:
-                freq = 1
-            entry = (dev, str(firstLogDate), str(lastLogDate), freq, '0', '0', 'None','0','None') 
+    pending = {}
+
+    # Hand the top level directories out to a pool of worker processes.  The results come back in the same order as the
+    # directories, so the devices are inserted exactly as they would be by a single process.  The settings the workers
+    # read are passed to them, so they do not depend on the processes being forked from this one
+    pool = None
+    if populateWorkers > 1 and len(tops) > 1:
+        state = dict([(name, globals()[name]) for name in ("logDirPath", "pathToOpLog", "manifestTree", "devicesDontAudit",\
+        "archiveIndexing", "archiveExtensions", "archiveIndex", "ioRateLimit", "ioBurst", "ioMaxConcurrency", "ioLatencyTarget",\
+        "ioBackoff", "asOf")])
+        try:
+            pool = multiprocessing.Pool(min(populateWorkers, len(tops)), populateWorkerStart, (min(populateWorkers, len(tops)), state))
+        except OSError as e:
+            log("[!] Failed to start the worker processes, reading the log tree in this process\n[!] Error: "+ str(e) +"\n")
+    if pool:
+        log("[-] Reading the log tree with "+ str(min(populateWorkers, len(tops))) +" worker processes\n")
+        results = pool.imap(populateTop, tops)
+    else:
+        results = map(populateTop, tops)
+
+    # Reading, summarising and inserting take turns for each top level directory.  They are timed and profiled as the
+    # repeated phases populate walk, populate summarize and populate insert.  With worker processes, the walk is the
+    # time spent waiting for their results
+    while True:
+        phaseBegin("populate walk", True)
+        result = next(results, None)
+        phaseEnd()
+        if result is None:
+            break
+        dirs, summaries, spill, archives = result
+        phaseBegin("populate summarize", True)
+        sumDirs += dirs
+        archiveUpdates.update(archives)
+        for dev, days in spill.items():
+            pending.setdefault(dev, set()).update(days)
+        for summary in summaries:
+            entry = populateEntry(summary)
+            if entry:
+                dbEntries.append(entry)
+                sumInactiveDevs += int(entry[5] == '1')
+        phaseEnd()
+
+        # Insert the devices found so far once there are enough of them
+        if len(dbEntries) >= populateChunkSize:
+            phaseBegin("populate insert", True)
+            sumDevs += populateInsert(c, conn, dbEntries)
+            phaseEnd()
+            log("[+] Inserted "+ str(sumDevs) +" devices, "+ str(sumDirs) +" directories read\n")
+            print("[+] Inserted "+ str(sumDevs) +" devices, "+ str(sumDirs) +" directories read")
+    if pool:
+        pool.close()
+        pool.join()
+
+    # Add the devices whose logs were spread over more than one top level directory
+    phaseBegin("populate summarize", True)
+    for dev, days in pending.items():
+        entry = populateEntry(populateSummary(dev, days))
+        if entry:
             dbEntries.append(entry)
+            sumInactiveDevs += int(entry[5] == '1')
+    phaseEnd()
+    phaseBegin("populate insert", True)
+    archiveSave(c)
+    sumDevs += populateInsert(c, conn, dbEntries)
+    phaseEnd()
+    phaseHeldEnd()
+    log("[+] Inserted "+ str(sumDevs) +" devices, "+ str(sumDirs) +" directories read\n")
+    log("[+] Found "+ str(sumInactiveDevs) +" inactive devices.  Use the inactive device report option for more information\n")
+    try:
+        conn.close()
+    except lite.Error as e:
+        log("[!] Failed to close the database\n[!] Error: "+ str(e) +"\n[!] Exiting\n\n")
+        cefMsg("Query Error",100)
+        print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
+        raise SystemExit
+    phaseEnd()
+    log("[+] Bulk insert completed successfully\n[-] All database population tasks completed successfully\n[-] Quitting.  Good bye.\n\n")
 
-        # Else determine the logging frequencey, set the frequency, and create the insert string
-        else:
-            i = 1
-            sumOfDateDifferences = datetime.timedelta(days=0)
-            dateSet = sorted(set(dates))
-
-            #print(dev)
-            #for i in dateSet:
-            #    print(i)
-
-            # Get sum of days between logs
-            while i < len(dateSet):
-                sumOfDateDifferences += dateSet[i] - dateSet[i-1]
-                i += 1
+# Read one top level directory of the log tree for dbPopulate
+# Takes a string of the directory path as an argument
+# Returns a list of the number of directories read, a list of summaries of the devices under the directory, a
+# dictionary of sets of day ordinals for any devices found outside of it, and a dictionary of the archives indexed
+def populateTop(top):
+    devDays = {}
+    dirs = 0
+    if not fsIsDir(top):
+        devName = getDevNameFromPath(top)
+        if devName[1]:
+            devDays[devName[0]] = set([devName[1].toordinal()])
+    for r, d, f in fsWalk(top):
+        dirs += 1
+        # Skip hidden directories and files
+        d[:] = [i for i in d if not i.startswith(".")]
+        files = [i for i in f if not i.startswith(".")]
+        if not files:
+            continue
 
-            # Calculate the average logging period
-            try:
-                avgDelta = sumOfDateDifferences / (len(dateSet) - 1)
-            except:
-                log("[!] Error calculating average logging period for "+ dev +"\n[!] Error: "+ str(sys.exc_info()[1]) +"\n[!] Exiting\n\n")
-                cefMsg("Math Error",100)
-                print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
-                raise SystemExit
-            if avgDelta.days == 0:
-                freq = '1'
-            elif avgDelta.days < 0:
-                log("[!] The calulated average logging frequency is negative: "+ str(avgDelta.days) +". Please inspect "+ dev +"\n[-] Continuing\n\n")
-                #print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
-                #raise SystemExit
+        # Every file in a directory with a date in its path belongs to the same device and day, otherwise the date
+        # has to come from the file name
+        devName = getDevNameFromPath(r)
+        if devName[1]:
+            devDays.setdefault(devName[0], set()).add(devName[1].toordinal())
+            continue
+        # Log archives without a date directory belong to the directory they are in
+        for name in files:
+            if archiveName(name):
                 continue
-            else:
-                freq = avgDelta.days
-
-            # Create the insert string and add it to the list
-            entry = (dev, str(firstLogDate), str(lastLogDate), freq,'0','0','None','0','None')
-            dbEntries.append(entry)
+            devName = getDevNameFromPath(r +"/"+ name)
+            if devName[1]:
+                devDays.setdefault(devName[0], set()).add(devName[1].toordinal())
+        days = archiveDirDays(r, files)
+        if days:
+            devDays.setdefault(r, set()).update(days)
+
+    summaries = []
+    spill = {}
+    for dev, days in devDays.items():
+        if dev == top or dev.startswith(top +"/"):
+            summaries.append(populateSummary(dev, days))
+        else:
+            spill[dev] = days
+
+    # Hand the archives indexed here back to the parent process to be saved
+    archives = dict(archiveUpdates)
+    archiveUpdates.clear()
+    return [dirs, summaries, spill, archives]
+
+# Set up a worker process with the parent's settings, leave CTRL+C to the parent process, which stops the worker
+# processes when it exits, and give the worker its share of the I/O rate
+# Takes the number of worker processes and a dictionary of the parent's module variables as arguments
+def populateWorkerStart(workers, state):
+    global ioGovernor
+    globals().update(state)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    ioGovernor = IoGovernor(ioRateLimit / workers)
+
+# Summarise the days a device has logs for
+# Takes a string of the device path and a set of day ordinals as arguments
+# Returns a tuple of the device path, the first and last day ordinals, the number of days, and True if the device is
+# on the skip list, else False
+def populateSummary(dev, days):
+    return (dev, min(days), max(days), len(days), bool([name for name in devicesDontAudit if name in dev]))
+
+# Determine whether a device is actively logging and its logging frequency from its summary
+# Takes a device summary from populateSummary() as an argument
+# Returns a tuple of values for the insert query, or None if the device is on the skip list
+def populateEntry(summary):
+    dev, first, last, numDays, skip = summary
+    if skip:
+        return None
+    dateToday = str(dateNow())
+    today = dateNow().toordinal()
+    firstLogDate = datetime.date.fromordinal(first)
+    lastLogDate = datetime.date.fromordinal(last)
+
+    # If the device hasn't logged in over 2 months, insert the device as inactive
+    if today - last > daysToInactive:
+        return (devRelName(dev), str(firstLogDate), str(lastLogDate), '1','0','1', dateToday,'1',dateToday, devRoot(dev))
+
+    # If there is only one log entry, set the frequency to half the number of days between now and the last log entry
+    if numDays == 1:
+        freq = ceil((today - last)/2)
+        if freq == 0:
+            freq = 1
+        return (devRelName(dev), str(firstLogDate), str(lastLogDate), freq, '0', '0', 'None','0','None', devRoot(dev))
+
+    # Else the average logging period is the span of days divided by the number of gaps between them
+    avgDelta = datetime.timedelta(days=last - first) / (numDays - 1)
+    if avgDelta.days == 0:
+        freq = '1'
+    else:
+        freq = avgDelta.days
+    return (devRelName(dev), str(firstLogDate), str(lastLogDate), freq,'0','0','None','0','None', devRoot(dev))
 
-    # Bulk insert all devices into the database
-    log("[+] Found "+ str(sumInactiveDevs) +" inactive devices.  Use the inactive device report option for more information\n")
+# Insert a chunk of devices into a fresh database in a single transaction and empty the list
+# Takes a sqlite3 cursor and connection and a list of tuples of values for the insert query as arguments
+# Returns the number of devices inserted
+def populateInsert(c, conn, dbEntries):
     log("[-] Starting bulk insert of "+ str(len(dbEntries)) +" devices into the database\n")
     try:
-        c.executemany("INSERT INTO {tn} ({dn}, {fs}, {ls}, {fq}, {cs}, {ia}, {iad}, {nl}, {nld}) VALUES (?,?,?,?,?,?,?,?,?)"\
-        .format(tn=tbl_devs, dn=col_dname, fs=col_fseen, ls=col_lseen, fq=col_freq, cs=col_crit, ia=col_inact, iad=col_idate, nl=col_nlog, nld=col_nldate), (dbEntries))
+        c.executemany("INSERT INTO {tn} ({dn}, {fs}, {ls}, {fq}, {cs}, {ia}, {iad}, {nl}, {nld}, {rid}) VALUES (?,?,?,?,?,?,?,?,?,?)"\
+        .format(tn=tbl_devs, dn=col_dname, fs=col_fseen, ls=col_lseen, fq=col_freq, cs=col_crit, ia=col_inact, iad=col_idate, nl=col_nlog, nld=col_nldate, rid=col_rootid), (dbEntries))
         conn.commit()
-        conn.close()
     except lite.Error as e:
         log("[!] Bulk insert of devices into fresh database failed\n[!] Error: "+ str(e) +"\n[!] Exiting\n\n")
         cefMsg("Query Error",100)
         print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
         raise SystemExit
-    log("[+] Bulk insert completed successfully\n[-] All database population tasks completed successfully\n[-] Quitting.  Good bye.\n\n")
+    inserted = len(dbEntries)
+    del dbEntries[:]
+    return inserted
             
 
 # Toggle the critical system or inactive setting or set the logging frequency on a device(s)
@@ -555,6 +2378,7 @@ def dbPopulate(c, conn, path):
 # The file must contain a single, case sensitive device name per line and nothing else
 # For logging frequency, each line should contain the device name and the frequency integer separated by a comma, e.g.: dev-1,20\n.
 def toggleStatus(filePath,pathToDB, option):
+    phaseBegin("toggle read")
     # Test filePath to make sure it leads to a file
     try:
         os.path.isfile(filePath)
@@ -581,7 +2405,7 @@ def toggleStatus(filePath,pathToDB, option):
 
     # Read device names into a list from the file, remove whitespace, and sanitize if not setting the logging frequencies
     if option != 3:
-        devs = [cleanDirName(line.strip()) for line in open(filePath)]
+        devs = [devRelName(cleanDirName(line.strip())) for line in open(filePath)]
         if not devs:
             log("[!] The file provided was empty\n[!] No work to be done, exiting\n\n")
             cefMsg("File Error",100)
@@ -604,6 +2428,8 @@ def toggleStatus(filePath,pathToDB, option):
             print("[!] Some devices that you put on the list were not found in the database\n[!] Check the log for more info\n\n")
     
     # Parse the options
+    phaseEnd()
+    phaseBegin("toggle update")
     dbEntries = []
     # Process for critical systems
     if option == 1:
@@ -634,7 +2460,7 @@ def toggleStatus(filePath,pathToDB, option):
 
     # Process for inactive
     elif option == 2:
-        dateToday = str(datetime.date.today())
+        dateToday = str(dateNow())
         # Start log
         log("----- "+ dateToday +" -----\n")
         log("[-] Starting process of toggling the \"Inactive\" setting for the specified devices\n")
@@ -675,7 +2501,7 @@ def toggleStatus(filePath,pathToDB, option):
             print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
             raise SystemExit
         for du in devsUnclean:
-            d = [cleanDirName(du.split(',')[0]), int(du.split(',')[1])]
+            d = [devRelName(cleanDirName(du.split(',')[0])), int(du.split(',')[1])]
             devs.append(d)
             dnames.append(d[0])
         
@@ -712,7 +2538,47 @@ def toggleStatus(filePath,pathToDB, option):
 
     # Close the database connection
     dbconn.close()
+    phaseEnd()
+
 
+# Order the devices for checking: critical systems first, then devices left unchecked by an earlier audit, then by how
+# close each device is to its due date (last_seen + freq), most overdue first
+# Takes a list of device tuples and a set of deferred dev_ids as arguments
+# Returns the sorted list of device tuples
+def auditSchedule(devs, deferred):
+    today = dateNow().toordinal()
+    def priority(dev):
+        try:
+            due = datetime.date(*[int(x) for x in dev[2].split("-")]).toordinal() + int(dev[3])
+        except (AttributeError, TypeError, ValueError):
+            due = today
+        return (0 if dev[4] else 1, 0 if dev[9] in deferred else 1, due - today)
+    return sorted(devs, key=priority)
+
+# Write a batch of audit results to the database and mark the devices as checked today, so that an interrupted audit
+# resumes without checking them again.  The lists are emptied once they are committed
+# Takes a sqlite3 connection and cursor, the lists of device updates, volume updates and checked dev_ids, today's date
+# string, and whether to record the checked devices in the checkpoint as arguments
+def auditCheckpoint(dbconn, dbc, dbUpdates, volUpdates, doneIds, dateToday, record=True):
+    log("[-] Performing bulk update of "+ str(len(dbUpdates)) +" known devices, "+ str(len(doneIds)) +" devices checked\n")
+    try:
+        dbc.executemany("UPDATE {tn} SET {dn} =?, {fs} =?, {ls}=?, {fq}=?, {cs}=?, {ia}=?, {iad}=?, {nl}=?, {nld}=? WHERE {did}=?"\
+        .format(tn=tbl_devs, dn=col_dname, fs=col_fseen, ls=col_lseen, fq=col_freq, cs=col_crit, ia=col_inact, iad=col_idate, nl=col_nlog, nld=col_nldate, did=col_devid),\
+        dbUpdates)
+        dbc.executemany("INSERT OR REPLACE INTO volume (dev_id, window) VALUES (?, ?)", volUpdates)
+        if record:
+            dbc.executemany("INSERT OR REPLACE INTO checkpoint (dev_id, run_date) VALUES (?, ?)", [(i, dateToday) for i in doneIds])
+        dbc.executemany("DELETE FROM deferred WHERE dev_id = ?", [(i,) for i in doneIds])
+        eventsFlush(dbc)
+        dbconn.commit()
+    except lite.Error as e:
+        log("[!] Bulk update of known devices during routine audit failed\n[!] Error: "+ str(e) +"\n[!] Exiting\n\n")
+        cefMsg("Query Error",100)
+        print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
+        raise SystemExit
+    del dbUpdates[:]
+    del volUpdates[:]
+    del doneIds[:]
 
 # Calculate the logging frequency of a range of dates
 # Takes a list of datetime date objects as an argument
@@ -738,11 +2604,129 @@ def calcFreq(dates):
     else:
         return abs(avgDelta.days)
 
+# Get the date of the last full audit that finished.  Databases from before audits were recorded fall back to the most
+# recent last_seen of any device
+# Takes a sqlite3 database cursor as an argument
+# Returns a datetime date object, or None if there is nothing to go by
+def auditLastRun(dbc):
+    try:
+        dbc.execute("SELECT MAX(run_date) FROM audit_runs")
+        last = dbc.fetchone()[0]
+        if not last:
+            dbc.execute("SELECT MAX({ls}) FROM {tn} WHERE {ls} GLOB '[0-9]*'".format(tn=tbl_devs, ls=col_lseen))
+            last = dbc.fetchone()[0]
+    except lite.Error as e:
+        log("[!] Failed to get the date of the last audit\n[!] Error: "+ str(e) +"\n[!] Exiting\n\n")
+        cefMsg("Query Error",100)
+        print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
+        raise SystemExit
+    if not last:
+        return None
+    return datetime.datetime.strptime(last, "%Y-%m-%d").date()
+
+# Catch up on the days missed since the last audit finished, up to yesterday.  Each active device's directory is read
+# once and the missed days are played through in order, as the daily audits would have: last_seen moves to the last
+# day with logs, a device that resumes has its frequency recalculated, and devices go overdue or inactive where the
+# audit would have set them.  Each change of status is sent as a CEF message and stored as an event of the day it
+# happened.  Every update is written in a single transaction.  Today is left to the audit that follows
+def runBackfill():
+    global backfillDone
+    phaseBegin("backfill")
+    backfillDone = True
+    dbconn = dbMakeConnection(pathToDB)
+    dbc = dbMakeCursor(dbconn)
+    fsCacheStart()
+    today = dateNow()
+    lastRun = auditLastRun(dbc)
+    if lastRun is None:
+        log("[!] No record of an earlier audit, there is nothing to backfill\n")
+        dbconn.close()
+        phaseEnd()
+        return
+    first = max(lastRun + datetime.timedelta(days=1), today - datetime.timedelta(days=daysToInactive))
+    missed = [first + datetime.timedelta(days=i) for i in range((today - first).days)]
+    if not missed:
+        log("[+] The last audit was on "+ str(lastRun) +", there are no missed days to backfill\n")
+        dbconn.close()
+        phaseEnd()
+        return
+    log("[-] Backfilling "+ str(len(missed)) +" missed days from "+ str(missed[0]) +" to "+ str(missed[-1]) +"\n")
+
+    pastInactive = datetime.timedelta(days=daysToInactive)
+    counters = runMetrics.setdefault("backfill", {"days": len(missed), "devices": 0, "advanced": 0, "resumed": 0, "not logging": 0, "inactive": 0})
+    dbUpdates = []
+    for dev in getActiveDeviceList(dbc)[0]:
+        if not dev[2] or not re.match(ptrnDateRecalcFreq, dev[2]):
+            continue
+        devDir = devAbsPath(dev[0], dev[10])
+        try:
+            names = set(fsListDir(devDir))
+        except OSError:
+            continue
+        counters["devices"] += 1
+        lastSeen = seenBefore = getDevNameFromPath("/"+ dev[2])[1]
+        freq = dev[3]
+        notLog = dev[7]
+        notLogDate = dev[8]
+        inactive = 0
+        # Send each change of status as it would have been sent on the day it happened.  Days up to the device's
+        # last_seen, which a -C run or an audit cut short may have moved past the last full audit, are already done
+        for day in missed:
+            if day <= seenBefore:
+                continue
+            if str(day) in names:
+                # A device that resumes gets its frequency from the days it has logged up to then
+                if notLog:
+                    dates = [getDevNameFromPath("/"+ n)[1] for n in names if re.match(ptrnDateRecalcFreq, n) and n <= str(day)]
+                    freq = calcFreq([d for d in dates if d]) or freq
+                    notLog = 0
+                    notLogDate = str(day)
+                    cefMsg(devDir, 5, day)
+                    counters["resumed"] += 1
+                lastSeen = day
+                continue
+            daysNotLog = day - lastSeen
+            if daysNotLog <= datetime.timedelta(days=freq):
+                continue
+            elif daysNotLog > pastInactive:
+                inactive = 1
+                cefMsg(devDir, 4, day)
+                counters["inactive"] += 1
+                break
+            elif not notLog:
+                notLog = 1
+                notLogDate = str(day)
+                cefMsg(devDir, 3, day)
+                counters["not logging"] += 1
+
+        # Save the device if anything changed
+        if str(lastSeen) != dev[2]:
+            counters["advanced"] += 1
+        if inactive or str(lastSeen) != dev[2] or notLog != dev[7]:
+            dbUpdates.append((dev[0], dev[1], str(lastSeen), freq, dev[4], inactive or dev[5], str(day) if inactive else dev[6], notLog, notLogDate, dev[9]))
+
+    log("[-] Performing bulk update of "+ str(len(dbUpdates)) +" backfilled devices\n")
+    try:
+        dbc.executemany("UPDATE {tn} SET {dn} =?, {fs} =?, {ls}=?, {fq}=?, {cs}=?, {ia}=?, {iad}=?, {nl}=?, {nld}=? WHERE {did}=?"\
+        .format(tn=tbl_devs, dn=col_dname, fs=col_fseen, ls=col_lseen, fq=col_freq, cs=col_crit, ia=col_inact, iad=col_idate, nl=col_nlog, nld=col_nldate, did=col_devid),\
+        dbUpdates)
+        eventsFlush(dbc)
+        dbconn.commit()
+        dbconn.close()
+    except lite.Error as e:
+        log("[!] Bulk update of backfilled devices failed\n[!] Error: "+ str(e) +"\n[!] Exiting\n\n")
+        cefMsg("Query Error",100)
+        print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
+        raise SystemExit
+    log("[+] Backfill of "+ str(counters["devices"]) +" devices completed, "+ str(counters["advanced"]) +" had logs on the missed days\n")
+    phaseEnd()
+
 # The script's basic functionality: step through directory tree, check for fresh logs, check for devices for which
 # the not logging frequency has been exceeded, check for devices that have resumed logging and reset their frequency, 
 # check for newly inactive devices, check for previously unknown devices and enter them into the database.
 # Takes two booleans as arguments
 def runAudit(critsOnly, report):
+    phaseBegin("audit setup")
     # Confirm databse location, establish database connection
     dbconn = dbMakeConnection(pathToDB)
 
@@ -752,6 +2736,16 @@ def runAudit(critsOnly, report):
     # Make sure there are no duplicate device name entries in the database
     dupCheck(dbc)
 
+    # Warn if audits have been missed since the last one finished
+    lastRun = auditLastRun(dbc)
+    if not critsOnly and not backfillDone and lastRun and (dateNow() - lastRun).days > 1:
+        log("[!] The last audit finished on "+ str(lastRun) +", "+ str((dateNow() - lastRun).days - 1) +" days were missed.  Run with --backfill to catch up on them\n")
+
+    # Every phase of the audit reads directories through the same cache
+    fsCacheStart()
+    if archiveIndexing:
+        archiveLoad(dbc)
+
     # Get list of actively logging devices
     if critsOnly:
         # If onlyCrits is set, only get critical systems
@@ -760,9 +2754,8 @@ def runAudit(critsOnly, report):
         # Get list of all actively logging and inactive devices.  Add inactive devices to DontAudit list
         devLists = getActiveDeviceList(dbc)
 
-    dateToday = str(datetime.date.today())
+    dateToday = str(dateNow())
     pastInactive = datetime.timedelta(days=daysToInactive)
-    dirDepth = logDirPath.count("/") + 1
     dbEntries = []
     dbUpdates = []
     devAnom = []
@@ -772,93 +2765,221 @@ def runAudit(critsOnly, report):
     newDevs = [] #
     delFromDict = [] #
 
+    volUpdates = []
+    doneIds = []
+    global auditRunning
+
+    # Get the log volume history if collecting log volume
+    if volumeTelemetry:
+        volWindows = volumeLoad(dbc)
+        runMetrics["volume"] = {"devices": 0, "files": 0, "bytes": 0, "drops": 0}
+
+    # Get the devices already checked today by a full audit that did not finish.  Critical system runs neither use nor
+    # record the checkpoint, so they never make the day's full audit skip a device
+    checkDone = set()
+    try:
+        if not critsOnly:
+            dbc.execute("DELETE FROM checkpoint WHERE run_date != ?", (dateToday,))
+            dbc.execute("SELECT dev_id FROM checkpoint")
+            checkDone = set([r[0] for r in dbc.fetchall()])
+    except lite.Error as e:
+        log("[!] Failed to get the audit checkpoint\n[!] Error: "+ str(e) +"\n[!] Exiting\n\n")
+        cefMsg("Query Error",100)
+        print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
+        raise SystemExit
+    if checkDone:
+        log("[+] Resuming an unfinished audit, "+ str(len(checkDone)) +" devices were already checked today\n")
+    runMetrics["checkpoint"] = {"resumed": len(checkDone), "checked": 0}
+
+    # Check the most important devices first
+    try:
+        dbc.execute("SELECT dev_id FROM deferred")
+        deferred = set([r[0] for r in dbc.fetchall()])
+    except lite.Error as e:
+        log("[!] Failed to get the devices deferred by the last audit\n[!] Error: "+ str(e) +"\n[!] Exiting\n\n")
+        cefMsg("Query Error",100)
+        print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
+        raise SystemExit
+    devLists[0] = auditSchedule(devLists[0], deferred)
+    runMetrics["schedule"] = {"deadline": auditDeadline, "carried over": len(deferred), "deferred": 0}
+    deadlineAt = time.time() + auditDeadline
+    deferIds = []
+
+    phaseEnd()
+    phaseBegin("audit freshness")
     log("[-] Checking active devices for fresh logs\n[-][-] "+ str(len(devLists[0])) +" active devices\n")
-    for dev in devLists[0]:
+    prefetch = [[], None]
+    if manifestTree is None:
+        prefetch = ioPrefetchStart([devAbsPath(d[0], d[10]) for d in devLists[0] if d[9] not in checkDone])
+    auditRunning = True
+    for devNum, dev in enumerate(devLists[0]):
+        # Leave the remaining devices for the next audit once the deadline has passed
+        if auditDeadline and time.time() > deadlineAt:
+            deferIds = [d[9] for d in devLists[0][devNum:] if d[9] not in checkDone]
+            break
+
+        # Separate standard paths from anomalous paths.  Standard devices sit directly under logDirPath
+        if "/" not in dev[0]:
+            devKnown.append(dev[0])
+        else:
+            devAnom.append(dev[0])
+
+        # Skip the devices already checked today
+        if dev[9] in checkDone:
+            continue
+        devDir = devAbsPath(dev[0], dev[10])
+
         # If there is a log from today, send CEF 1.  If device was not logging before, send CEF 5,
         # recalc the frequency, and update the database entry
-        if dateToday in os.listdir(dev[0]):
-            cefMsg(dev[0], 1) 
+        todayEntry = [e for e in fsScanDir(devDir) if e.name == dateToday]
+        if todayEntry:
+            cefMsg(devDir, 1) 
+
+            # Count today's files and bytes and send CEF 7 if the volume has dropped
+            if volumeTelemetry and manifestTree is None:
+                files, size = volumeScan(todayEntry[0])
+                window = volWindows.setdefault(dev[9], [])
+                if volumeCheck(window, files, size):
+                    log("[!] "+ devDir +" has logged "+ str(size) +" bytes in "+ str(files) +" files today, below its usual volume\n")
+                    cefMsg(devDir, 7)
+                    runMetrics["volume"]["drops"] += 1
+                volUpdates.append((dev[9], ",".join([":".join([str(x) for x in day]) for day in window])))
+                runMetrics["volume"]["devices"] += 1
+                runMetrics["volume"]["files"] += files
+                runMetrics["volume"]["bytes"] += size
             # If the device was "not logging" reset it
             if dev[7]:
                 # Get a list of all subdirectories, filter date formatting, change to datetime object
                 dates = []
-                for d in os.listdir(dev[0]):
+                for d in fsListDir(devDir):
                     if re.match(ptrnDateRecalcFreq, d):
                         dates.append(datetime.date(int(d.split("-")[0]),int(d.split("-")[1]),int(d.split("-")[2])))
                 freq = calcFreq(dates) 
                 if freq == 0:
-                    log("[!] Unable to calculate the logging frequency for "+ dev[0] +"\n[!] Exiting\n\n")
+                    log("[!] Unable to calculate the logging frequency for "+ devDir +"\n[!] Exiting\n\n")
                     cefMsg("Math Error",100)
                     print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
                     raise SystemExit
                 entry = (dev[0], dev[1], dateToday, freq, dev[4], dev[5], dev[6], 0, dateToday, dev[9])
-                cefMsg(dev[0], 5)
+                cefMsg(devDir, 5)
             else:
                 entry = (dev[0], dev[1], dateToday, dev[3], dev[4], dev[5], dev[6], dev[7], dev[8], dev[9])
             dbUpdates.append(entry)
         else:
-            daysNotLog = datetime.date.today() - datetime.date(int(dev[2].split("-")[0]),int(dev[2].split("-")[1]),int(dev[2].split("-")[2]))
+            daysNotLog = dateNow() - datetime.date(int(dev[2].split("-")[0]),int(dev[2].split("-")[1]),int(dev[2].split("-")[2]))
             # If the device has not logged recently, but is not overdue, send CEF 2 and move on
             if daysNotLog <= datetime.timedelta(days=dev[3]):
-                cefMsg(dev[0], 2)
+                cefMsg(devDir, 2)
 
             # If the device has not logged in longer than the predefined limit, send CEF 4 and set it as inactive 
             elif daysNotLog > pastInactive:
-                cefMsg(dev[0],4)
+                cefMsg(devDir, 4)
                 entry = (dev[0], dev[1], dev[2], dev[3], dev[4], 1, dateToday, dev[7], dev[8], dev[9])
                 dbUpdates.append(entry)
 
             # If the device is past its logging frequency send CEF 0
             else:
-                cefMsg(dev[0], 0)
+                cefMsg(devDir, 0)
 
                 # If the device isn't already set to "not logging", set it and send CEF 3
                 if not dev[7]:
-                    cefMsg(dev[0],3)
+                    cefMsg(devDir, 3)
                     entry = (dev[0], dev[1], dev[2], dev[3], dev[4], dev[5], dev[6], 1, dateToday, dev[9])
                     dbUpdates.append(entry)
 
-        # Separate standard paths from anomalous paths
-        if dev[0].count("/") == dirDepth:
-            devKnown.append(dev[0])
-        else:
-            devAnom.append(dev[0])
+        # Save the results every checkpointBatch devices, or now if a stop was requested
+        doneIds.append(dev[9])
+        runMetrics["checkpoint"]["checked"] += 1
+        if len(doneIds) >= checkpointBatch or stopRequested:
+            auditCheckpoint(dbconn, dbc, dbUpdates, volUpdates, doneIds, dateToday, not critsOnly)
+        if stopRequested:
+            if prefetch[0]:
+                ioPrefetchStop(prefetch)
+            log("[!] Audit stopped, it will resume from here on the next run\n[!] Exiting\n\n")
+            print("\n[!] Audit stopped, it will resume from here on the next run\n[!] Quitting\n\n")
+            raise SystemExit
+    if prefetch[0]:
+        ioPrefetchStop(prefetch)
+    auditCheckpoint(dbconn, dbc, dbUpdates, volUpdates, doneIds, dateToday, not critsOnly)
+    auditRunning = False
+    phaseEnd()
+
+    # If the deadline passed, record the devices that were not checked and skip the search for new devices.  The
+    # checkpoint is kept so that another audit today carries on where this one stopped
+    if deferIds:
+        log("[!] Audit deadline of "+ str(auditDeadline) +" seconds reached, "+ str(len(deferIds)) +" devices were not checked\n")
+        runMetrics["schedule"]["deferred"] = len(deferIds)
+        try:
+            dbc.executemany("INSERT OR REPLACE INTO deferred (dev_id, deferred_date) VALUES (?, ?)", [(i, dateToday) for i in deferIds])
+            # The day was audited, the deferred devices are checked first by the next audit rather than by a backfill
+            if not critsOnly:
+                dbc.execute("INSERT OR REPLACE INTO audit_runs (run_date, finished) VALUES (?, ?)", (dateToday, str(datetime.datetime.now()).split(".")[0]))
+            eventsFlush(dbc)
+            dbconn.commit()
+            dbconn.close()
+        except lite.Error as e:
+            log("[!] Failed to save the devices deferred to the next audit\n[!] Error: "+ str(e) +"\n[!] Exiting\n\n")
+            cefMsg("Query Error",100)
+            print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
+            raise SystemExit
+        if report:
+            log("[-] Generating report\n")
+            reportMake()
+        metricsLog()
+        log("[+] Deferred devices saved\n[-] Skipping the search for new devices\n[-] Quitting.  Good bye.\n\n")
+        return
 
     # Sort the inactive devices
+    phaseBegin("audit discovery")
     log("[-] Sorting inactive devices\n[-][-] "+ str(len(devLists[1])) +" inactive devices\n")
     for dev in devLists[1]:
-        if dev[0].count("/") == dirDepth:
+        if "/" not in dev[0]:
             devKnown.append(dev[0])
         else:
             devAnom.append(dev[0])
 
     # Get logging directory listings
-    devAll = os.listdir(logDirPath)
+    devAll = fsListDir(logDirPath)
     log("[+] Got directory listing for "+ logDirPath +": "+ str(len(devAll)) +" device directories\n")
 
-    # Prepend logging path to dev name
-    devAll = [logDirPath +"/"+ i for i in devAll]
-
     log("[-] Removing known standard devices, unmonitored devices, and device directories with no subdirectories\n")
     # Remove known standard devices from device list
     devUnknown = list(set(devAll) - set(devKnown))
     #print(str(len(devUnknown)))
 
     # Remove unmonitored devices (View clients, etc)
-    removeThese = [i for i in devUnknown for j in devicesDontAudit if j in i]
+    removeThese = [i for i in devUnknown if [j for j in devicesDontAudit if j in logDirPath +"/"+ i]]
     #print(str(len(set(removeThese))))
     devUnknown = list(set(devUnknown) - set(removeThese))
 
+    # Skip directories that were already searched without finding any devices and have not changed since
+    discNegative = {}
+    useDiscCache = discoveryCache and manifestTree is None
+    if useDiscCache:
+        runMetrics["discovery cache"] = {"hits": 0, "misses": 0, "stats": 0, "new": 0, "gone": 0}
+        discCached = discoveryLoad(dbc)
+        if logDirPath in discCached:
+            listingPrev = set(discCached[logDirPath][1])
+            listingNow = set(devAll)
+            runMetrics["discovery cache"]["new"] = len(listingNow - listingPrev)
+            runMetrics["discovery cache"]["gone"] = len(listingPrev - listingNow)
+            log("[+] "+ str(len(listingNow - listingPrev)) +" directories appeared and "+ str(len(listingPrev - listingNow)) +" disappeared since the last audit\n")
+        discSkip = [i for i in devUnknown if devAbsPath(i) in discCached and discoveryUnchanged(discCached[devAbsPath(i)][0])]
+        runMetrics["discovery cache"]["hits"] = len(discSkip)
+        runMetrics["discovery cache"]["misses"] = len(devUnknown) - len(discSkip)
+        devUnknown = list(set(devUnknown) - set(discSkip))
+        log("[+] Skipped "+ str(len(discSkip)) +" unchanged directories that have no devices\n")
+
     #print(str(len(devUnknown)))
     # Identify, enter into db, and remove listed devices with no log files
-    devEmpty = [i for i in devUnknown if not os.listdir(i)]
+    devEmpty = [i for i in devUnknown if not fsListDir(devAbsPath(i))]
     #print(str(len(devEmpty)))
     for dev in devEmpty:
-        entry = (dev, dateToday, dateToday, 1, 0, 1, dateToday, 1, dateToday)    
+        entry = (dev, dateToday, dateToday, 1, 0, 1, dateToday, 1, dateToday, rootId)    
         dbEntries.append(entry)
-        cefMsg(dev, 3)
-        cefMsg(dev, 4)
-        cefMsg(dev, 6)
+        cefMsg(devAbsPath(dev), 3)
+        cefMsg(devAbsPath(dev), 4)
+        cefMsg(devAbsPath(dev), 6)
     log("[+] Added "+ str(len(dbEntries)) +" device directories with no subdirectories to the database\n")
 
 		# Remove the device with no subdirectories from the list of unknown devices
@@ -866,27 +2987,52 @@ def runAudit(critsOnly, report):
 
     # Remove anomalous parent dirs from devUnknown
     # Get a list of parent pathes with devices in subdirectories
-    parentPaths = list(set([i for i in devUnknown for j in devAnom if i in j]))
-    pathsKnown = list(set([i for i in devAnom for j in parentPaths if j in i]))
+    parentPaths = list(set([i for i in devUnknown for j in devAnom if j.startswith(i +"/")]))
+    pathsKnown = list(set([i for i in devAnom for j in parentPaths if i.startswith(j +"/")]))
+    devAnomSet = set(devAnom)
     #for i in parentPaths:
     #  print(i)
     log("[-] Beginning to process "+ str(len(parentPaths)) +" anomalous logging directories\n")
     for path in parentPaths:
         tree = []
         pathWithFile = []
+        visited = []
+        devsBefore = len(dictDevDate)
+        path = devAbsPath(path)
+
+        # Use the layout templates first, skipping the anomalous devices already in the database
+        found = layoutDiscover(path, visited)
+        if found:
+            for dev, dates in found.items():
+                if devRelName(dev) not in devAnomSet:
+                    dictDevDate.setdefault(dev, [])
+                    dictDevDate[dev].extend(dates)
+            # The known devices change every day, so leave them out of the cached snapshot
+            if len(dictDevDate) == devsBefore:
+                discNegative[path] = [i for i in visited if i not in found]
+            continue
+        if not layoutFallbackWalk:
+            continue
 
         # Get tree of subdirectories
-        for r,d,f in os.walk(path, topdown=True):
+        for r,d,f in fsWalk(path):
             tree.append([r,d,f])
 
         # Loop through subdirectories, ID, and process found devices
         for subDir in tree[1:]:
             # If this path ends in files add the path to the list
-            known = [i for i in pathsKnown if i in subDir[0]]
+            subName = devRelName(subDir[0])
+            known = [i for i in pathsKnown if subName == i or subName.startswith(i +"/")]
             if not known:
                 if subDir[2]:
                     #print(subDir[0])
                     pathWithFile.append(subDir[0])
+                    # Files under a date directory already have their day, only look for archives elsewhere
+                    archives = archiveDirDays(subDir[0], subDir[2]) if not getDevNameFromPath(subDir[0])[1] else set()
+                    if archives:
+                        dictDevDate.setdefault(subDir[0], [])
+                        dictDevDate[subDir[0]].extend([datetime.date.fromordinal(day) for day in sorted(archives)])
+                        pathWithFile.pop()
                 # Else if the path has subdirectories and their names are date formatted, 
                 # add the path/device name to the dictionary, but no dates
                 elif subDir[1] and (subDir[1][0] == 'today' or subDir[1][0] == 'yesterday' or re.match('[0-9]{4}-[0-9]{2}-[0-9]{2}', subDir[1][0])):
@@ -900,6 +3046,10 @@ def runAudit(critsOnly, report):
             else:
                 dictDevDate.setdefault(devName[0], [])
                 dictDevDate[devName[0]].append(devName[1])    
+
+        # Remember the parent path if nothing new was found, leaving out the known devices
+        if len(dictDevDate) == devsBefore:
+            discNegative[path] = [t[0] for t in tree if not [i for i in pathsKnown if devRelName(t[0]) == i or devRelName(t[0]).startswith(i +"/")]]
     
     # Remove the known parent paths for known anomalous devices
     devUnknown = list(set(devUnknown) - set(parentPaths))            
@@ -909,10 +3059,30 @@ def runAudit(critsOnly, report):
     log("[-] Processing "+ str(len(devUnknown)) +" unknown devices\n")
     for d in devUnknown:
         pathWithFile = []
+        visited = []
+        d = devAbsPath(d)
+        devPath = d
+        devsBefore = len(dictDevDate)
+
+        # Use the layout templates first and only walk the whole directory if none of them match
+        found = layoutDiscover(d, visited)
+        if found:
+            for dev, dates in found.items():
+                dictDevDate.setdefault(dev, [])
+                dictDevDate[dev].extend(dates)
+            continue
+        if not layoutFallbackWalk:
+            discNegative[devPath] = visited + [devPath]
+            continue
   
-        for r,d,f in os.walk(d, topdown=True):
+        for r,d,f in fsWalk(d):
+            visited.append(r)
             if f:
                 pathWithFile.append(r)
+                archives = archiveDirDays(r, f) if not getDevNameFromPath(r)[1] else set()
+                if archives:
+                    dictDevDate.setdefault(r, [])
+                    dictDevDate[r].extend([datetime.date.fromordinal(day) for day in sorted(archives)])
             elif d and (d[0] == 'today' or d[0] == 'yesterday' or re.match('[0-9]{4}-[0-9]{2}-[0-9]{2}', d[0])):
                 dictDevDate.setdefault(r, [])
 
@@ -926,6 +3096,10 @@ def runAudit(critsOnly, report):
             else:
                 dictDevDate.setdefault(devName[0], [])
                 dictDevDate[devName[0]].append(devName[1])
+
+        # Remember the directory if nothing was found under it
+        if len(dictDevDate) == devsBefore:
+            discNegative[devPath] = visited
     
 		# If there are any unknown devices were discovered and entered into the dictionary, process them
     if dictDevDate:
@@ -935,36 +3109,42 @@ def runAudit(critsOnly, report):
         log("[-] Adding "+ str(len(dictDevDate)) +" newly discovered devices to the database\n")
         for dev, dates in dictDevDate.items():
             if dates:
-                entry = (dev, str(min(dates)), str(max(dates)), 1, 0, 0, None, 0, None)
+                entry = (devRelName(dev), str(min(dates)), str(max(dates)), 1, 0, 0, None, 0, None, devRoot(dev))
                 dbEntries.append(entry)
                 cefMsg(dev, 6)
             else:
-                entry = (dev, None, None, 1, 0, 1, dateToday, 1, dateToday)
+                entry = (devRelName(dev), None, None, 1, 0, 1, dateToday, 1, dateToday, devRoot(dev))
                 dbEntries.append(entry)
                 cefMsg(dev, 3)
                 cefMsg(dev, 4)
                 cefMsg(dev, 6)
 
 
-    # Update the device database entries
-    log("[-] Performing bulk update of "+ str(len(dbUpdates)) +" known devices\n")
-    try:
-        dbc.executemany("UPDATE {tn} SET {dn} =?, {fs} =?, {ls}=?, {fq}=?, {cs}=?, {ia}=?, {iad}=?, {nl}=?, {nld}=? WHERE {did}=?"\
-        .format(tn=tbl_devs, dn=col_dname, fs=col_fseen, ls=col_lseen, fq=col_freq, cs=col_crit, ia=col_inact, iad=col_idate, nl=col_nlog, nld=col_nldate, did=col_devid),\
-        dbUpdates)
-    except lite.Error as e:
-        log("[!] Bulk update of known devices during routine audit failed\n[!] Error: "+ str(e) +"\n[!] Exiting\n\n")
-        cefMsg("Query Error",100)
-        print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
-        raise SystemExit
-    log("[+] Known devices status successfully updated in the database\n")
+    phaseEnd()
+
+    # Save the directories that had no devices and the current listing of logDirPath in the discovery cache
+    phaseBegin("audit save")
+    if useDiscCache:
+        log("[-] Saving "+ str(len(discNegative)) +" directories without devices in the discovery cache\n")
+        discEntries = [(path, json.dumps(discoverySnapshot(visited)), None, dateToday) for path, visited in discNegative.items()]
+        discEntries.append((logDirPath, None, json.dumps(sorted(devAll)), dateToday))
+        try:
+            dbc.executemany("INSERT OR REPLACE INTO discovery (path, mtimes, listing, checked) VALUES (?, ?, ?, ?)", discEntries)
+            devAllSet = set(devAll)
+            dbc.executemany("DELETE FROM discovery WHERE path = ?", [(path,) for path in discCached if path != logDirPath and devRelName(path) not in devAllSet])
+            dbc.executemany("DELETE FROM discovery WHERE path = ?", [(dev,) for dev in dictDevDate])
+        except lite.Error as e:
+            log("[!] Update of the discovery cache during routine audit failed\n[!] Error: "+ str(e) +"\n[!] Exiting\n\n")
+            cefMsg("Query Error",100)
+            print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
+            raise SystemExit
 
     # Insert newly discovered devices into the database
     if dbEntries: 
         log("[-] Performing bulk insert of "+ str(len(dbEntries)) +" newly found devices\n")
         try:
-            dbc.executemany("INSERT INTO {tn} ({dn}, {fs}, {ls}, {fq}, {cs}, {ia}, {iad}, {nl}, {nld}) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)"\
-            .format(tn=tbl_devs, dn=col_dname, fs=col_fseen, ls=col_lseen, fq=col_freq, cs=col_crit, ia=col_inact, iad=col_idate, nl=col_nlog, nld=col_nldate),\
+            dbc.executemany("INSERT INTO {tn} ({dn}, {fs}, {ls}, {fq}, {cs}, {ia}, {iad}, {nl}, {nld}, {rid}) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"\
+            .format(tn=tbl_devs, dn=col_dname, fs=col_fseen, ls=col_lseen, fq=col_freq, cs=col_crit, ia=col_inact, iad=col_idate, nl=col_nlog, nld=col_nldate, rid=col_rootid),\
             dbEntries)
         except lite.Error as e:
             log("[!] Bulk insert of new devices during routine audit failed\n[!] Error: "+ str(e) +"\n[!] Exiting\n\n")
@@ -976,6 +3156,13 @@ def runAudit(critsOnly, report):
     # Commit changes and close the database connection
     log("[-] Commiting changes to the database\n")
     try:
+        if not critsOnly:
+            dbc.execute("DELETE FROM checkpoint")
+            dbc.execute("INSERT OR REPLACE INTO audit_runs (run_date, finished) VALUES (?, ?)", (dateToday, str(datetime.datetime.now()).split(".")[0]))
+        archiveSave(dbc)
+        eventsFlush(dbc)
+        dbc.execute("DELETE FROM events WHERE day < ?", (dateNow().toordinal() - eventRetentionDays,))
+        dbc.execute("DELETE FROM event_counts WHERE day < ?", (dateNow().toordinal() - eventRetentionDays,))
         dbconn.commit()
         dbconn.close()
     except lite.Error as e:
@@ -983,12 +3170,14 @@ def runAudit(critsOnly, report):
         cefMsg("Query Error",100)
         print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
         raise SystemExit
+    phaseEnd()
 
     # If the report flag set, print the report
     if report:
         log("[-] Generating report\n")
         reportMake()
 
+    metricsLog()
     log("[+] Changes successfully committed to the database\n[+] All auditing tasks completed successfully\n[-] Quitting.  Good bye.\n\n")
 
 
@@ -999,19 +3188,139 @@ def main(argv):
     report= False
     # Capture CTRL+C and exit gracefully
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
 
     # Confirm ops log location and writability
     logStart()
 
+    # Write out any CEF messages and device events still buffered when the program exits.  Exit handlers run newest
+    # first, so the run lock is registered first to be released only after everything else is written
+    atexit.register(lockRelease)
+    atexit.register(outboxClose)
+    atexit.register(eventsSave)
+
     # Get any commandline arguments and handle them
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hpCrf:i:c:", ["help","populate","onlyCrits","--report", "frequency=","inactive=","critical="])
+        opts, args = getopt.getopt(sys.argv[1:], "hpCrf:i:c:m:d:", ["help","populate","onlyCrits","report", "frequency=","inactive=","critical=","manifest=","deadline=","since=","until=","memory","workers=","serve","profile","profile-sample","drain","backfill","every=","as-of=","live"])
     except:
         log("[!] Failed to capture commandline arguments\n[!] Error: "+ str(sys.exc_info()[1]) +"\n[!] Exiting\n\n")
         cefMsg("CLI argument Error",100)
         print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
         raise SystemExit
 
+    # Handle the options that change how the other options run first
+    global auditDeadline, dbInMemory, populateWorkers, auditEvery, asOf, dateToday, hourNow, hourPrev, dbScratch, cefDryRun
+    reportSince = None
+    backfill = False
+    live = False
+    reportUntil = None
+    for opt, arg in opts:
+        # Read the manifest before any other option uses the log directory structure
+        if opt in ("-m", "--manifest"):
+            manifestLoad(arg)
+
+        # Set the time limit for checking devices
+        elif opt in ("-d", "--deadline"):
+            try:
+                auditDeadline = int(arg)
+                if auditDeadline < 0:
+                    raise ValueError("negative deadline")
+            except ValueError:
+                log("[!] The deadline must be a whole number of seconds\n[!] Error: "+ str(sys.exc_info()[1]) +"\n[!] Exiting\n\n")
+                cefMsg("CLI argument Error",100)
+                print("[!] Commandline syntax error.  Check the log for more details or try '-h'\n\n")
+                raise SystemExit
+
+        # Set the number of worker processes for populating
+        elif opt == "--workers":
+            try:
+                populateWorkers = int(arg)
+                if populateWorkers < 1:
+                    raise ValueError("at least one worker is needed")
+            except ValueError:
+                log("[!] The number of workers must be a whole number above 0\n[!] Error: "+ str(sys.exc_info()[1]) +"\n[!] Exiting\n\n")
+                cefMsg("CLI argument Error",100)
+                print("[!] Commandline syntax error.  Check the log for more details or try '-h'\n\n")
+                raise SystemExit
+
+        # Work on an in-memory copy of the database
+        elif opt == "--memory":
+            dbInMemory = True
+
+        # Keep running, auditing every given number of seconds
+        elif opt == "--every":
+            try:
+                auditEvery = int(arg)
+                if auditEvery < 1:
+                    raise ValueError("the interval must be at least 1 second")
+            except ValueError:
+                log("[!] The audit interval must be a whole number of seconds\n[!] Error: "+ str(sys.exc_info()[1]) +"\n[!] Exiting\n\n")
+                cefMsg("CLI argument Error",100)
+                print("[!] Commandline syntax error.  Check the log for more details or try '-h'\n\n")
+                raise SystemExit
+
+        # Catch up on missed days before auditing
+        elif opt == "--backfill":
+            backfill = True
+
+        # Treat the given day, and optionally hour, as now
+        elif opt == "--as-of":
+            try:
+                if "T" in arg:
+                    asOf = datetime.datetime.strptime(arg, "%Y-%m-%dT%H")
+                else:
+                    asOf = datetime.datetime.strptime(arg, "%Y-%m-%d").replace(hour=23)
+            except ValueError:
+                log("[!] The --as-of date must be formatted YYYY-MM-DD or YYYY-MM-DDTHH\n[!] Error: "+ str(sys.exc_info()[1]) +"\n[!] Exiting\n\n")
+                cefMsg("CLI argument Error",100)
+                print("[!] Commandline syntax error.  Check the log for more details or try '-h'\n\n")
+                raise SystemExit
+            dateToday = str(asOf.date())
+            hourNow = asOf.hour
+            hourPrev = 23 if hourNow == 0 else hourNow - 1
+
+        # Let a manifest run write to the database and send CEF messages
+        elif opt == "--live":
+            live = True
+
+        # Profile each phase of the run
+        elif opt in ("--profile", "--profile-sample"):
+            if profileMode:
+                log("[!] Only one of --profile and --profile-sample can be used\n[!] Exiting\n\n")
+                cefMsg("CLI argument Error",100)
+                print("[!] Commandline syntax error.  Check the log for more details or try '-h'\n\n")
+                raise SystemExit
+            profileStart("full" if opt == "--profile" else "sample")
+
+        # Set the dates of the event report
+        elif opt in ("--since", "--until"):
+            try:
+                reportDate = datetime.datetime.strptime(arg, "%Y-%m-%d").date()
+            except ValueError:
+                log("[!] Report dates must be formatted YYYY-MM-DD\n[!] Error: "+ str(sys.exc_info()[1]) +"\n[!] Exiting\n\n")
+                cefMsg("CLI argument Error",100)
+                print("[!] Commandline syntax error.  Check the log for more details or try '-h'\n\n")
+                raise SystemExit
+            if opt == "--since":
+                reportSince = reportDate
+            else:
+                reportUntil = reportDate
+
+    # Unless --live is given, a manifest run is a replay or a benchmark.  It works on a scratch in-memory copy of the
+    # database and only logs the CEF messages it would send
+    if manifestTree is not None and not live:
+        dbInMemory = True
+        dbScratch = True
+        cefDryRun = True
+        log("[-] Manifest run, the database will not be changed and CEF messages will not be sent.  Use --live to change this\n")
+
+    # Count the options and arguments, leaving out the ones that only change how the others run
+    numArgs = len([o for o in opts if o[0] not in ("-m", "--manifest", "-d", "--deadline", "--since", "--until", "--memory", "--workers", "--profile", "--profile-sample", "--backfill", "--every", "--as-of", "--live")]) + len(args)
+
+    # Make sure no other copy of the program is writing to the database.  The status server only reads it
+    if not [o for o in opts if o[0] in ("-h", "--help", "--serve")]:
+        lockAcquire()
+
     if len(sys.argv) >= 2:
         for opt, arg in opts:
             # We all need help sometimes
@@ -1021,7 +3330,7 @@ def main(argv):
 
             # Recalculate the logging frequency for a specified device(s)
             elif opt in ("-f", "--frequency"):
-                if len(sys.argv) > 3:
+                if numArgs > 1:
                     log("[!] Too many arguments for the frequency command\n[!] Please provide the path to a single text file containing the relevant devices\n")
                     log("[!] Exiting\n\n")
                     cefMsg("CLI argument Error",100)
@@ -1033,7 +3342,7 @@ def main(argv):
 
             # Toggle the "critical system" status of a device(s)
             elif opt in ("-c", "--critical"):
-                if len(sys.argv) > 3:
+                if numArgs > 1:
                     log("[!] Too many arguments for the frequency command\n[!] Please provide the path to a single text file containing the relevant devices\n")
                     log("[!] Exiting\n\n")
                     cefMsg("CLI argument Error",100)
@@ -1045,7 +3354,7 @@ def main(argv):
 
             # Toggle the "inactive" status of a device(s)
             elif opt in ("-i", "--inactive"):
-                if len(sys.argv) > 3:
+                if numArgs > 1:
                     log("[!] Too many arguments for the frequency command\n[!] Please provide the path to a single text file containing the relevant devices\n")
                     log("[!] Exiting\n\n")
                     cefMsg("CLI argument Error",100)
@@ -1057,7 +3366,7 @@ def main(argv):
 
             # Populate a fresh database
             elif opt in ("-p", "--populate"):
-                if len(sys.argv) > 2:
+                if numArgs > 1:
                     log("[!] Too many arguments for the populate command\n[!] Check your syntax and try again\n[!] Exiting\n\n")
                     cefMsg("CLI argument Error",100)
                     print("[!] Commandline syntax error.  Check the log for more details or try '-h'\n\n")
@@ -1070,8 +3379,9 @@ def main(argv):
                     print("\n[!] The program has experienced a fatal error\n[!] Please check the log for details\n[!] Quitting\n\n")
                     raise SystemExit
 
-                # Initialize the database
-                dbinit.initDB()
+                # Initialize the database.  A scratch run populates an empty in-memory database instead
+                if not dbScratch:
+                    dbinit.initDB()
 
                 # Confirm new database presence, connect, and create the cursor
                 dbconn = dbMakeConnection(pathToDB)
@@ -1083,7 +3393,7 @@ def main(argv):
 
             # Only check critical systems for fresh logs
             elif opt in ("-C", "--onlyCrits"):
-                if len(sys.argv) > 2:
+                if numArgs > 1:
                     log("[!] Too many arguments for onlyCrits command\n[!] Check your syntax and try again\n[!] Exiting\n\n")
                     cefMsg("CLI argument Error",100)
                     print("[!] Commandline syntax error.  Check the log for more details or try '-h'\n\n")
@@ -1091,9 +3401,29 @@ def main(argv):
                 else:
                     critsOnly = True
 
+            # Deliver the CEF messages left in the outbox
+            elif opt == "--drain":
+                if numArgs > 1:
+                    log("[!] Too many arguments for the drain command\n[!] Check your syntax and try again\n[!] Exiting\n\n")
+                    cefMsg("CLI argument Error",100)
+                    print("[!] Commandline syntax error.  Check the log for more details or try '-h'\n\n")
+                    raise SystemExit
+                outboxDrainAll()
+                raise SystemExit
+
+            # Serve the device status over HTTP
+            elif opt == "--serve":
+                if numArgs > 1:
+                    log("[!] Too many arguments for the serve command\n[!] Check your syntax and try again\n[!] Exiting\n\n")
+                    cefMsg("CLI argument Error",100)
+                    print("[!] Commandline syntax error.  Check the log for more details or try '-h'\n\n")
+                    raise SystemExit
+                statusServe()
+                raise SystemExit
+
             # Print a full report
             elif opt in ("-r", "--report"):
-                if len(sys.argv) > 2:
+                if numArgs > 1:
                     log("[!] Too many arguments for onlyCrits command\n[!] Check your syntax and try again\n[!] Exiting\n\n")
                     cefMsg("CLI argument Error",100)
                     print("[!] Commandline syntax error.  Check the log for more details or try '-h'\n\n")
@@ -1101,8 +3431,32 @@ def main(argv):
                 else:
                     report = True
 
-    # Audit the logging structure
-    runAudit(critsOnly, report)
+    # Report on the device events between two dates instead of auditing
+    if report and (reportSince or reportUntil):
+        if not reportUntil:
+            reportUntil = dateNow()
+        if not reportSince:
+            reportSince = reportUntil - datetime.timedelta(days=30)
+        eventReport(reportSince, reportUntil)
+        raise SystemExit
+
+    # Catch up on the days missed since the last audit, then audit the logging structure
+    # Keep auditing every auditEvery seconds if it is set
+    if backfill:
+        runBackfill()
+    # Between audits the run lock is released so that other copies of the program can run.  The audit has written the
+    # in-memory database back by then, and it is loaded again if they change it
+    while True:
+        started = time.time()
+        runAudit(critsOnly, report)
+        if not auditEvery:
+            break
+        outboxClose()
+        lockRelease()
+        log("[-] Next audit in "+ str(max(0, int(started + auditEvery - time.time()))) +" seconds\n")
+        time.sleep(max(0, started + auditEvery - time.time()))
+        lockAcquire(True)
+        runReset()
 
 
 ######################################################################################################################
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3.5
+######################################################################################################################
+# NAME
+## statuscheck
+#
+# SYNOPSYS
+## statuscheck.py /path/to/database/file.db
+#
+# DESCRIPTION
+## Checks the logtracker status server against a database.  Starts the server on a free port on localhost, requests
+## every endpoint, and compares the answers with the database.  Prints a line for each check and exits with 1 if any
+## of them failed, else 0.  The database is opened read-only and nothing is written to the operations log
+#
+# SEE ALSO
+## logtracker.py --serve
+######################################################################################################################
+##### Import List #####
+import sys
+import json       # For reading the status responses
+import shutil     # For removing the scratch operations log
+import tempfile   # For a scratch operations log
+import threading  # For running the server next to the checks
+import urllib.error       # For the status codes of failed requests
+import urllib.parse       # For quoting device names
+import urllib.request     # For requesting the status endpoints
+import sqlite3 as lite    # For comparing the answers with the database
+import dbinit     # Imported before logtracker, which imports it in turn
+import logtracker
+
+failures = 0
+
+######################################################################################################################
+### Function definitions ###
+
+# Request a path from the status server
+# Takes the base URL, the path, and optionally an ETag to send in If-None-Match as arguments
+# Returns a list of the HTTP status code, the decoded JSON body or None, and the ETag
+def fetch(base, path, etag=None):
+    request = urllib.request.Request(base + path)
+    if etag:
+        request.add_header("If-None-Match", etag)
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return [response.status, json.loads(response.read().decode()), response.headers.get("ETag")]
+    except urllib.error.HTTPError as e:
+        body = e.read()
+        return [e.code, json.loads(body.decode()) if body else None, e.headers.get("ETag")]
+
+# Print the result of a check and count it if it failed
+# Takes a string describing the check and True if it passed as arguments
+def check(name, passed):
+    global failures
+    if passed:
+        print("[+] "+ name)
+    else:
+        failures += 1
+        print("[!] FAILED: "+ name)
+
+######################################################################################################################
+### Main ###
+def main(argv):
+    if len(argv) != 1:
+        print("Usage: statuscheck.py /path/to/database/file.db")
+        raise SystemExit(2)
+    logtracker.pathToDB = argv[0]
+    logtracker.pathToOpLog = tempfile.mkdtemp(prefix="statuscheck")
+
+    # Count the devices in the database to compare with the answers
+    try:
+        dbconn = lite.connect("file:"+ argv[0] +"?mode=ro", uri=True)
+        total, critical, overdue = dbconn.execute("SELECT count(*), sum(crit_sys = 1), sum(not_log = 1 AND inactive = 0) FROM devices").fetchone()
+        firstDevice = dbconn.execute("SELECT dev_name FROM devices ORDER BY dev_id LIMIT 1").fetchone()
+        dbconn.close()
+    except lite.Error as e:
+        print("[!] Unable to read the database\n[!] Error: "+ str(e))
+        raise SystemExit(1)
+
+    server = logtracker.statusServerMake("127.0.0.1", 0)
+    serverThread = threading.Thread(target=server.serve_forever)
+    serverThread.daemon = True
+    serverThread.start()
+    base = "http://127.0.0.1:"+ str(server.server_address[1])
+    print("[-] Checking the status server at "+ base)
+    try:
+        code, body, etag = fetch(base, "/stats")
+        check("/stats answers 200", code == 200)
+        check("/stats counts "+ str(total) +" devices", body["devices"] == total)
+        check("/stats counts "+ str(critical or 0) +" critical devices", body["critical"] == (critical or 0))
+        check("/stats counts "+ str(overdue or 0) +" devices not logging", body["not_logging"] == (overdue or 0))
+        check("/stats sends an ETag", bool(etag))
+        code, body, unused = fetch(base, "/stats", etag)
+        check("/stats answers 304 to a matching If-None-Match", code == 304)
+
+        code, body, etag = fetch(base, "/overdue")
+        check("/overdue lists "+ str(overdue or 0) +" devices", code == 200 and body["total"] == (overdue or 0) and len(body["devices"]) == body["total"])
+        code, body, etag = fetch(base, "/critical")
+        check("/critical lists "+ str(critical or 0) +" devices", code == 200 and body["total"] == (critical or 0) and len(body["devices"]) == body["total"])
+
+        if firstDevice:
+            code, body, etag = fetch(base, "/device/"+ urllib.parse.quote(firstDevice[0]))
+            check("/device/ finds "+ firstDevice[0], code == 200 and body["name"] == firstDevice[0])
+        code, body, etag = fetch(base, "/device/statuscheck-no-such-device")
+        check("/device/ answers 404 for an unknown device", code == 404)
+        code, body, etag = fetch(base, "/no-such-path")
+        check("An unknown path answers 404", code == 404)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        check("The status server answered every request ("+ str(e) +")", False)
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(logtracker.pathToOpLog, ignore_errors=True)
+
+    print("[-] "+ str(failures) +" checks failed")
+    raise SystemExit(1 if failures else 0)
+
+
+######################################################################################################################
+if __name__ == "__main__":
+    main(sys.argv[1:])